@@ -1,6 +1,7 @@
 import sublime, sublime_plugin, time, re
 
 from .lib.misc import *
+from .lib import word_index, vocabulary
 
 #
 # Called when the system is initialized.
@@ -12,11 +13,12 @@ def plugin_loaded():
     extra_word_characters = settings_helper.get("sbp_syntax_specific_extra_word_characters")
     separator_characters = settings_helper.get("sbp_sexpr_separators", default_sbp_sexpr_separators)
 
+# maximum number of completions we return
+MAX_COMPLETIONS = 100
+
 #
 # Switch buffer command that sorts buffers by last access and displays file name as well.
 #
-MIN_AUTO_COMPLETE_WORD_SIZE = 3
-MAX_AUTO_COMPLETE_WORD_SIZE = 100
 class CompleteAllBuffers(sublime_plugin.EventListener):
     def on_query_completions(self, view, prefix, locations):
         if settings_helper.get("sbp_use_internal_complete_all_buffers") != True:
@@ -29,19 +31,18 @@ class CompleteAllBuffers(sublime_plugin.EventListener):
         if len(prefix) == 0:
             return None
 
-        seen = set()
         seen_buffers = set()
-        words = []
-        re_by_syntax = {}
+        queries = []
+        prefix_by_syntax = {}
 
         # get a sorted (by last access) list of views in the current window
         window = sublime.active_window()
         views = ViewState.sorted_views(window)
 
-        # determine the set of root directories in the current project if possible
-        roots = get_project_roots()
+        # time budget in seconds - 0 means index every buffer right now no matter how long it takes
+        budget = (settings_helper.get("sbp_complete_all_buffers_time_budget") or 0) / 1000.0
         start = time.time()
-        re_flags = sublime.IGNORECASE if prefix.lower() == prefix else 0
+        ignore_case = prefix.lower() == prefix
         for v in views:
             if v.is_scratch() or v.buffer_id() in seen_buffers:
                 continue
@@ -49,83 +50,103 @@ class CompleteAllBuffers(sublime_plugin.EventListener):
             # only check each buffer once, starting with the most recently accessed instance of that
             # buffer
             seen_buffers.add(v.buffer_id())
-            point = 0
-            sel = v.selection
-            if len(sel) > 0:
-                point = sel[-1].begin()
 
-            # Determine regex by syntax. Rewrite the prefix so it does fuzzy matching rather than
-            # strict prefix matching.
             syntax_name = v.settings().get("syntax")
-            regex_info = re_by_syntax.get(syntax_name, None)
-            if regex_info is None:
-                extra = extra_word_characters.get(syntax_name) or ""
-                word_re = r'[\w' + extra + r']'
-                not_word_re = r'[^\w' + extra + r']+'
-
-                # If the prefix starts with non-word characters, we need to strip them out now,
-                # perform the match without them, and then add them back in at the end.
-                match = re.match(not_word_re, prefix)
-                if match:
-                    stripped_prefix = match.group(0)
-                    if stripped_prefix == prefix:
-                        continue
-                    this_prefix = prefix[len(stripped_prefix):]
-                else:
-                    this_prefix = prefix
-                    stripped_prefix = ""
-
-                re_prefix = (word_re + '*').join(re.escape(p) for p in this_prefix)
-
-                # If our starting character is not considered a word character, we cannot use '\b'
-                # to start this regex.
-                if this_prefix[0] in separator_characters:
-                    regex = ""
-                else:
-                    regex = r'\b'
-                regex += re_prefix + word_re + r'+\b'
-                re_by_syntax[syntax_name] = (regex, stripped_prefix)
+            extra = extra_word_characters.get(syntax_name) or ""
+            prefix_info = prefix_by_syntax.get(syntax_name, None)
+            if prefix_info is None:
+                prefix_by_syntax[syntax_name] = prefix_info = self.split_prefix(prefix, extra)
+            this_prefix, stripped_prefix = prefix_info
+            if len(this_prefix) == 0:
+                continue
+
+            # We only build an index now if it fits in what's left of the budget. Otherwise we use the
+            # indexes we already have and build the rest in the background, so they are there for the
+            # next completion.
+            remaining = budget - (time.time() - start)
+            build = budget <= 0 or (remaining > 0 and word_index.can_index_within(v.size(), remaining * 1000))
+            query = self.make_query(v, this_prefix, stripped_prefix, extra, view, build)
+            if query is None:
+                word_index.build_async(v, extra, separator_characters)
             else:
-                regex, stripped_prefix = regex_info
+                queries.append(query)
 
-            view_words = self.extract_completions_from_view(v, regex, re_flags, point, view, seen)
-            if len(view_words) == 0:
-                continue
+        # words from files that have been closed come last
+        vocab = None
+        fallback_queries = []
+        if settings_helper.get("sbp_complete_all_buffers_vocabulary", True):
+            vocab = vocabulary.get_vocabulary()
+            this_prefix, stripped_prefix = self.split_prefix(prefix, extra_word_characters.get(view.settings().get("syntax")) or "")
+            if vocab is not None and len(this_prefix) > 0:
+                fallback_queries.append((vocab, this_prefix, None, (None, stripped_prefix)))
 
+        # determine the set of root directories in the current project if possible
+        roots = get_project_roots()
+        words = []
+        for word, (v, stripped_prefix) in word_index.top_completions(queries, ignore_case, MAX_COMPLETIONS, fallback_queries):
             # figure the best way to display the file name unless this is the current view
-            if v == view:
+            if v is None:
+                file_name = get_relative_path(roots, vocab.file_for(word))
+            elif v == view:
                 file_name = None
             else:
                 file_name = get_relative_path(roots, v.file_name())
 
-            for word in view_words:
-                # add the stripped prefix back in to the trigger and the word
-                if len(stripped_prefix) > 0:
-                    word = stripped_prefix + word
-                if v == view:
-                    trigger = "%s\t  [HERE]" % (word,)
-                else:
-                    trigger = "%s\t  %s" % (word, file_name)
-                words.append((trigger, word.replace("$", "\\$")))
+            # add the stripped prefix back in to the trigger and the word
+            if len(stripped_prefix) > 0:
+                word = stripped_prefix + word
+            if file_name is None:
+                trigger = "%s\t  [HERE]" % (word,)
+            else:
+                trigger = "%s\t  %s" % (word, file_name)
+            words.append((trigger, word.replace("$", "\\$")))
         tm = time.time() - start
         if tm > 0.20:
             print("COMPLETE in", time.time() - start)
         return (words, sublime.INHIBIT_WORD_COMPLETIONS)
 
-    def extract_from_view(self, view, prefix, point):
-        return view.extract_completions(prefix, point)
-
-    def extract_completions_from_view(self, view, regex, re_flags, point, current_view, seen):
-        regions = sorted(view.find_all(regex, re_flags), key=lambda r: abs(point - r.begin()))
-        results = []
-        is_current_view = view == current_view or view.buffer_id() == current_view.buffer_id()
-        for region in regions:
-            if is_current_view and region.contains(point):
-                continue
-            if MIN_AUTO_COMPLETE_WORD_SIZE <= region.size() <= MAX_AUTO_COMPLETE_WORD_SIZE:
-                word = view.substr(region)
-                if word not in seen:
-                    results.append(word)
-                    seen.add(word)
-        return results
-
+    def on_modified(self, view):
+        word_index.on_modified(view)
+
+    def on_selection_modified(self, view):
+        word_index.on_selection_modified(view)
+
+    def on_activated(self, view):
+        word_index.on_selection_modified(view)
+
+    def on_pre_close(self, view):
+        if not ViewState.is_last_view(view):
+            # the buffer is still open in another view
+            return
+        index = word_index.indexes.get(view.buffer_id(), None)
+        if index is not None and settings_helper.get("sbp_complete_all_buffers_vocabulary", True):
+            vocabulary.record(index, view.file_name())
+        word_index.on_close(view)
+
+    #
+    # If the prefix starts with non-word characters (for a syntax with the specified extra word
+    # characters), we need to strip them out, perform the match without them, and then add them back
+    # in at the end. Returns the prefix to match and the stripped characters.
+    #
+    def split_prefix(self, prefix, extra):
+        match = re.match(r'[^\w' + re.escape(extra) + r']+', prefix)
+        if match:
+            stripped_prefix = match.group(0)
+            return (prefix[len(stripped_prefix):], stripped_prefix)
+        return (prefix, "")
+
+    #
+    # Returns a completion engine query for the specified view, or None if the view hasn't been
+    # indexed and build is False. The word the cursor is on in the current view doesn't count (it's
+    # the one being completed), unless it also appears somewhere else.
+    #
+    def make_query(self, view, prefix, stripped_prefix, extra, current_view, build):
+        index = word_index.index_for(view, extra, separator_characters, build)
+        if index is None:
+            return None
+        exclude = None
+        if view.buffer_id() == current_view.buffer_id():
+            sel = current_view.sel()
+            if len(sel) > 0:
+                exclude = index.word_at(current_view, sel[-1].b)
+        return (index, prefix, exclude, (view, stripped_prefix))
@@ -6,6 +6,7 @@ from copy import copy
 from .lib.misc import *
 from .lib import kill_ring
 from .lib import isearch
+from .lib import occur
 
 import Default.paragraph as paragraph
 from . import sbp_layout as ll
@@ -22,14 +23,33 @@ class ViewWatcher(sublime_plugin.EventListener):
         super(ViewWatcher, self).__init__(*args, **kwargs)
         self.pending_dedups = 0
 
+    def on_pre_close(self, view):
+        ViewState.on_view_pre_close(view)
+
+    #
+    # Sublime Text 4 calls this when it quits (Sublime Text 3 doesn't, and doesn't call
+    # plugin_unloaded then either). The API has already shut down, so we write our files directly.
+    #
+    def on_exit(self):
+        isearch.flush_search_settings_file()
+        kill_ring.flush_save()
+
     def on_close(self, view):
         ViewState.on_view_closed(view)
+        occur.on_close(view)
 
     def on_activated(self, view):
         update_pinned_status(view)
 
     def on_deactivated(self, view):
         self.disable_empty_active_mark(view)
+        ViewState.save_touched_for(view)
+
+        # we might be switching to another app, which should see our most recent kill
+        kill_ring.flush_clipboard()
+
+    def on_pre_save(self, view):
+        ViewState.save_touched_for(view)
 
     def on_activated_async(self, view):
         info = isearch.info_for(view)
@@ -818,6 +838,24 @@ class SbpSetMarkCommand(SbpTextCommand):
             if settings_helper.get("sbp_active_mark_mode", False):
                 util.set_active_mark_mode()
 
+#
+# Go to the most recent mark in the global mark ring, which remembers where marks were set in
+# other buffers. Repeating this cycles through them.
+#
+class SbpPopGlobalMarkCommand(SbpTextCommand):
+    def run_cmd(self, util):
+        window = self.view.window()
+        target = pop_global_mark(window)
+        if target is None:
+            util.set_status("No global marks")
+            return
+        view, regions = target
+        if view.window() is not None:
+            view.window().focus_view(view)
+        if regions:
+            CmdUtil(view).set_cursors(regions)
+            view.show(regions[0])
+
 class SbpCancelMarkCommand(SbpTextCommand):
     def run_cmd(self, util):
         if util.state.active_mark:
@@ -1192,27 +1230,50 @@ class SbpYankCommand(SbpTextCommand):
         util.ensure_visible(util.get_last_cursor())
 
 #
-# Like the yank command except it displays a menu of all the kills and lets you choose which one to
-# yank.
+# Choose a kill ring entry to yank from a quick panel. If search is True, we first prompt for a string
+# (or a regex) and only show the entries which contain it.
 #
 class SbpChooseAndYank(SbpTextCommand):
-    def run_cmd(self, util, all_cursors=False):
-        # items is an array of (index, text) pairs
-        items = kill_ring.get_popup_sample(util.view)
+    def run_cmd(self, util, all_cursors=False, search=False, regex=False):
+        def choose(items):
+            # items is an array of (index, text) pairs
+            def on_done(idx):
+                if idx >= 0:
+                    index = items[idx][0]
+
+                    if all_cursors:
+                        util.run_command("sbp_yank_all_cursors", {"index": index})
+                    else:
+                        util.run_command("sbp_yank", {"index": index})
 
-        def on_done(idx):
-            if idx >= 0:
-                index = items[idx][0]
+            if items:
+                sublime.active_window().show_quick_panel([item[1] for item in items], on_done)
+            else:
+                util.set_status('Nothing in history' if not search else 'No matching kills')
 
-                if all_cursors:
-                    util.run_command("sbp_yank_all_cursors", {"index": index})
+        if search:
+            def on_search(query):
+                indexes = kill_ring.search(query, regex)
+                if indexes is None:
+                    util.set_status("Invalid regular expression")
                 else:
-                    util.run_command("sbp_yank", {"index": index})
+                    choose(kill_ring.get_popup_sample(util.view, indexes))
 
-        if items:
-            sublime.active_window().show_quick_panel([item[1] for item in items], on_done)
+            prompt = "Search kill ring%s:" % (" (regex)" if regex else "")
+            sublime.active_window().show_input_panel(prompt, "", on_search, None, None)
         else:
-            util.set_status('Nothing in history')
+            choose(kill_ring.get_popup_sample(util.view))
+
+#
+# Report how many entries there are in the kill ring and how much text they hold, in memory and on
+# disk.
+#
+class SbpKillRingUsageCommand(SbpTextCommand):
+    def run_cmd(self, util):
+        n_entries, in_memory, n_spilled, spilled = kill_ring.memory_usage()
+        mb = 1024.0 * 1024.0
+        util.set_status("Kill ring: %d entries, %.1f MB in memory, %d on disk (%.1f MB)" %
+                        (n_entries, in_memory / mb, n_spilled, spilled / mb))
 
 #
 # Like the yank command except this automatically creates the number of cursors you need to handle
@@ -1281,6 +1342,10 @@ class SbpIncSearchCommand(SbpTextCommand):
                 view.run_command("move_to", {"to": "eof"})
             elif cmd == "history":
                 info.history(**kwargs)
+            elif cmd == "occur":
+                info.done()
+                if info.current and info.current.search:
+                    info.view.run_command("sbp_occur", {"search": info.current.search, "regex": info.regex})
             else:
                 print("Not handling cmd", cmd, kwargs)
 
@@ -1290,6 +1355,52 @@ class SbpIncSearchCommand(SbpTextCommand):
         # for now we hide it.
         return True
 
+#
+# List all the lines in all the buffers in this window which match a search string, like occur and
+# multi-occur in emacs. The search string is prompted for unless it's supplied (e.g., by i-search).
+# A prefix argument toggles regex mode.
+#
+class SbpOccurCommand(SbpTextCommand):
+    def run_cmd(self, util, search=None, regex=False):
+        if util.state.argument_supplied:
+            regex = not regex
+        window = self.view.window()
+
+        def on_done(search):
+            if search and occur.occur(window, search, regex) is None:
+                util.set_status("Invalid regular expression")
+
+        if search is None:
+            default = isearch.get_saved_search() or ""
+            window.show_input_panel("%sOccur:" % ("Regexp " if regex else ""), default, on_done, None, None)
+        else:
+            on_done(search)
+
+#
+# Commands for the occur results view: jump to the match on the current line, or update the
+# contents of the (read only) view.
+#
+class SbpOccurResultsCommand(SbpTextCommand):
+    def run_cmd(self, util, cmd, text=None):
+        view = self.view
+        if cmd == "goto":
+            results = occur.occur_for(view)
+            target = results.target_at(view.rowcol(util.get_point())[0]) if results else None
+            if target is None:
+                util.set_status("No match on this line")
+                return
+            target_view, point = target
+            target_view.window().focus_view(target_view)
+            CmdUtil(target_view).push_mark_and_goto_position(point)
+            target_view.show_at_center(point)
+        else:
+            view.set_read_only(False)
+            if cmd == "clear":
+                view.erase(util.edit, sublime.Region(0, view.size()))
+            elif cmd == "append":
+                view.insert(util.edit, view.size(), text)
+            view.set_read_only(True)
+
 class SbpIncSearchEscapeCommand(SbpTextCommand):
     # unregistered = True
     def run_cmd(self, util, next_cmd, next_args):
@@ -1585,3 +1696,9 @@ def plugin_loaded():
 
     # preprocess this module
     preprocess_module(sys.modules[__name__])
+
+def plugin_unloaded():
+    ViewState.save_all_touched()
+    isearch.flush_search_settings()
+    kill_ring.flush_clipboard()
+    kill_ring.flush_save()
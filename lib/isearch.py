@@ -2,7 +2,8 @@
 #            Better incremental search              #
 #####################################################
 
-import re
+import re, time, os, json
+from collections import OrderedDict
 from copy import copy
 
 import sublime, sublime_plugin
@@ -18,6 +19,31 @@ REGION_SELECTED = "rs"
 isearch_history_settings = None
 ISEARCH_SETTINGS_FILE = "sublemacspro_isearch_history.sublime-settings"
 
+# Buffers larger than this (in characters) have the matches in the visible region found first, so
+# that the highlighting and cursor movement happen right away. The rest are found afterwards.
+VIEWPORT_FIRST_SIZE = 1000000
+
+# Changes to the search string which arrive within this many milliseconds of the previous one are
+# coalesced, so that only the most recent string is searched for.
+CHANGE_COALESCE_DELAY = 30
+
+# minimum time between redraws of the matches (milliseconds)
+FRAME_TIME = 16
+
+# Literal searches with no more than this many matches are refined by checking just the previous
+# matches when characters are appended to the search string, rather than searching the buffer again.
+REFINE_LIMIT = 2000
+
+# The text around the previous matches is fetched in chunks of (at least) this many characters when
+# refining, so that nearby matches are checked without going back to sublime for each one.
+REFINE_CHUNK_SIZE = 64 * 1024
+
+# number of search patterns we remember the flags and compiled regex for
+PATTERN_CACHE_SIZE = 128
+
+# maximum number of matches we highlight (the ones nearest the current match) - 0 means no limit
+isearch_max_highlights = 1000
+
 # ring buffer of saved searches - actual values loaded from settings
 isearch_history_size = 64
 
@@ -27,10 +53,22 @@ isearch_current = 0
 # most recently accessed via up/down arrows
 isearch_index = 0
 
+# how long to wait before writing the history to disk after it changes (milliseconds)
+HISTORY_SAVE_DELAY = 2000
+history_dirty = False
+history_save_scheduled = False
+
+# where sublime keeps the history settings, for writing them ourselves when sublime is quitting
+history_path = None
+
 def initialize():
     global isearch_history_settings, isearch_history, isearch_current, isearch_history_size
+    global isearch_max_highlights, history_path
 
-    isearch_history_size = SettingsHelper().get("sbp_isearch_history_size", 64)
+    history_path = os.path.join(sublime.packages_path(), "User", ISEARCH_SETTINGS_FILE)
+    settings_helper = SettingsHelper()
+    isearch_history_size = settings_helper.get("sbp_isearch_history_size", 64)
+    isearch_max_highlights = settings_helper.get("sbp_isearch_max_highlights", 1000)
 
     isearch_history_settings = sublime.load_settings(ISEARCH_SETTINGS_FILE)
     if isearch_history_settings.get("isearch_current") is None:
@@ -42,10 +80,10 @@ def initialize():
         isearch_history = isearch_history_settings.get("items")
         if len(isearch_history) > isearch_history_size:
             isearch_history = isearch_history[:isearch_history_size]
-            save_search_settings()
+            schedule_save_search_settings()
         elif len(isearch_history) < isearch_history_size:
             isearch_history = isearch_history + [None] * (isearch_history_size - len(isearch_history))
-            save_search_settings()
+            schedule_save_search_settings()
 
 
 isearch_info = dict()
@@ -81,13 +119,47 @@ def save_search(search):
 
         # reset the index to the new current whenever one is added
         isearch_index = isearch_current
+        schedule_save_search_settings()
+
+#
+# The history is kept in memory and written to disk at most once every HISTORY_SAVE_DELAY
+# milliseconds, rather than every time a search finishes, and when the plugin is unloaded.
+#
+def schedule_save_search_settings():
+    global history_dirty, history_save_scheduled
+    history_dirty = True
+    if not history_save_scheduled:
+        history_save_scheduled = True
+        sublime.set_timeout(flush_search_settings, HISTORY_SAVE_DELAY)
+
+def flush_search_settings():
+    global history_save_scheduled
+    history_save_scheduled = False
+    if history_dirty:
         save_search_settings()
 
 def save_search_settings():
+    global history_dirty
+    history_dirty = False
     isearch_history_settings.set("isearch_current", isearch_current)
     isearch_history_settings.set("items", isearch_history)
     sublime.save_settings(ISEARCH_SETTINGS_FILE)
 
+#
+# Write the history to its settings file directly if it has changed. This is for when sublime is
+# quitting and its API has already shut down.
+#
+def flush_search_settings_file():
+    global history_dirty
+    if not history_dirty or history_path is None:
+        return
+    history_dirty = False
+    try:
+        with open(history_path, "w") as f:
+            json.dump({"isearch_current": isearch_current, "items": isearch_history}, f, indent=4)
+    except (IOError, OSError) as e:
+        print("Error saving i-search history", e)
+
 #
 # Get the most recently saved search string.
 #
@@ -110,7 +182,7 @@ def cycle_history(dir):
 class ISearchInfo():
     def __init__(self, view, forward, regex):
         self.view = view
-        self.current = StackItem("", [], [], -1, forward, False)
+        self.current = StackItem("", [], Selection(), -1, forward, False)
         self.util = CmdUtil(view)
         self.window = view.window()
         self.point = self.util.get_cursors(True)
@@ -129,6 +201,16 @@ class ISearchInfo():
         # else
         self.view_change_count = 0
 
+        # the most recent search string which hasn't been searched for yet (see on_change)
+        self.pending_change = None
+        self.change_scheduled = False
+        self.last_change_time = 0
+
+        # redraws are scheduled by update() and happen at most once per frame
+        self.redraw_scheduled = False
+        self.last_redraw_time = 0
+        self.finished = False
+
     def is_valid(self):
         if self.view_change_count != self.input_view.change_count():
             return False
@@ -143,20 +225,59 @@ class ISearchInfo():
             item = item.prev
         self.util.set_cursors(self.point)
         self.current = item
-        if True or self.test_string(text):
-            # REMIND: recreate the search one character at a time unless it's > 500, in which case
-            # that can be quite slow
-            self.in_append_from_cursor = True
+        self.pending_change = None
+        if text:
             self.append_group_id += 1
-            if len(text) < 1000:
-                for index in range(0, len(text)):
-                    self.on_change(text[0:index])
-            else:
-                self.on_change(text)
-            self.in_append_from_cursor = False
+            self.replay(text, self.append_group_id)
         self.set_text(text, False)
         self.update()
 
+    #
+    # Push the state for searching for text from scratch, as though it was typed one character at a
+    # time. Rather than actually searching for each prefix of text, we search for the whole thing and
+    # create the states for the shorter prefixes if and when the user pops back to them (see
+    # materialize). If the whole thing fails, we find the longest prefix that doesn't with a binary
+    # search, so that the failing part of the string is highlighted as usual. Items which end up
+    # incomplete are completed when the user pops back to them.
+    #
+    def replay(self, text, group_id):
+        pos = self.point[-1].b
+        base = self.current
+        si = self.find_item(text, base, pos, group_id)
+        if not si.selected and len(text) > 1:
+            lo, hi = 0, len(text)
+            good = None
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                item = self.find_item(text[:mid], base, pos, group_id)
+                if item.selected:
+                    lo, good = mid, item
+                else:
+                    hi = mid
+            if good is not None:
+                good.lazy = True
+                self.push(good)
+        si.lazy = True
+        self.push(si)
+        if not si.complete:
+            self.complete_later(si)
+
+    #
+    # Make sure the state for the search string one character shorter than the specified lazy item's
+    # is on the stack right before it.
+    #
+    def materialize(self, item):
+        if not item.lazy or len(item.prev.search) >= len(item.search) - 1:
+            return
+        forward = self.forward
+        self.forward = item.forward
+        new = self.find_item(item.search[:-1], item.prev, self.point[-1].b, item.group_id)
+        self.forward = forward
+        self.complete_item(new)
+        new.lazy = True
+        new.prev = item.prev
+        item.prev = new
+
     def open(self):
         window = self.view.window()
         in_error_str = "" if self.not_in_error() else "Failing "
@@ -196,51 +317,209 @@ class ISearchInfo():
             self.in_changes -= 1
             return
 
+        # Changes can arrive faster than we can search, e.g., with auto-repeat or when yanking into
+        # the panel. The first change is handled right away but any which follow it within
+        # CHANGE_COALESCE_DELAY are coalesced, so that only the latest search string is searched for.
+        self.pending_change = val
+        if not self.change_scheduled:
+            delay = CHANGE_COALESCE_DELAY - (time.time() - self.last_change_time) * 1000
+            if delay <= 0:
+                self.flush_change()
+            else:
+                self.change_scheduled = True
+                sublime.set_timeout(self.on_change_timeout, int(delay))
+
+    def on_change_timeout(self):
+        self.change_scheduled = False
+        if not self.finished:
+            self.flush_change()
+
+    #
+    # Search for the pending search string, if any. Commands which depend on the current state call
+    # this first.
+    #
+    def flush_change(self):
+        val = self.pending_change
+        if val is not None:
+            self.pending_change = None
+            self.apply_change(val)
+
+    def apply_change(self, val):
         if self.current and self.current.search == val:
             # sometimes sublime calls us when nothing has changed
             return
-
+        self.last_change_time = time.time()
         self.find(val)
 
     def search_flags(self, search_string):
-        # determine if this is case sensitive search or not
-        flags = 0 if self.regex else sublime.LITERAL
-        if not re.search(r'[A-Z]', search_string):
-            flags |= sublime.IGNORECASE
-        return flags
+        return get_search_pattern(search_string, self.regex).flags
 
     #
     # Test a search string to see if it exists anywhere in the buffer.
     #
     def test_string(self, val):
-        flags = self.search_flags(val)
-        regions = self.view.find_all(val, flags)
+        pattern = get_search_pattern(val, self.regex)
+        if not pattern.valid:
+            return False
+        regions = self.view.find_all(val, pattern.flags)
         return len(regions) > 0
 
     def find(self, val):
-        flags = self.search_flags(val)
-
         # find all instances if we have a search string
         if len(val) > 0:
-            regions = self.view.find_all(val, flags)
-
             # find the closest match to where we currently are
             pos = None
             if self.current:
                 pos = self.current.get_point()
             if pos is None:
                 pos = self.point[-1].b
-            index = self.find_closest(regions, pos, self.forward)
 
             # push this new state onto the stack
             group_id = self.append_group_id if self.in_append_from_cursor else None
-            si = StackItem(val, regions, [], index, self.forward, self.current.wrapped, group_id)
+            si = self.find_item(val, self.current, pos, group_id)
             self.push(si)
-        else:
-            regions = None
-            index = -1
+            if not si.complete:
+                self.complete_later(si)
         self.update()
 
+    #
+    # Returns a new StackItem for the specified search string, which will follow prev on the stack,
+    # with the match closest to pos as the current one. In large buffers the item may only contain
+    # the matches in the visible region, in which case it's marked as incomplete and the caller needs
+    # to arrange for complete_item to be called. A regex which is obviously incomplete (as it is
+    # while it's being typed) fails without searching the buffer at all.
+    #
+    def find_item(self, val, prev, pos, group_id):
+        pattern = get_search_pattern(val, self.regex)
+        flags = pattern.flags
+        regions = [] if not pattern.valid else self.refine(prev, val, flags)
+        complete = True
+        if regions is None and self.view.size() > VIEWPORT_FIRST_SIZE:
+            regions = self.find_visible(pattern, pos)
+            complete = regions is None
+        if regions is None:
+            regions = self.view.find_all(val, flags)
+        index = self.find_closest(regions, pos, self.forward)
+        si = StackItem(val, regions, Selection(), index, self.forward, prev.wrapped, group_id)
+        si.complete = complete
+        return si
+
+    #
+    # When a literal search string is extended, the new matches can only be where the old ones were,
+    # so we check just those rather than searching the whole buffer again. Returns None if we can't
+    # do that.
+    #
+    # This is only right if the old search string cannot overlap itself (e.g., "aa" or "abab"),
+    # because find_all doesn't return overlapping matches, so some occurrences of the old string
+    # might not be in the old matches.
+    #
+    # We fetch the text around the old matches a chunk at a time and compare in python, since a
+    # round trip to sublime per match costs more than one find_all on an ordinary buffer.
+    #
+    def refine(self, prev, val, flags):
+        if self.regex or not prev.complete or not prev.search or not val.startswith(prev.search):
+            return None
+        if not prev.regions:
+            # nothing matched before so nothing will match now
+            return []
+        if len(prev.regions) > REFINE_LIMIT:
+            return None
+        old = prev.search.lower() if self.search_flags(prev.search) & sublime.IGNORECASE else prev.search
+        for n in range(1, len(old)):
+            if old[:n] == old[-n:]:
+                return None
+
+        ignore_case = flags & sublime.IGNORECASE
+        target = val.lower() if ignore_case else val
+        size = len(val)
+        view = self.view
+        regions = []
+        end = -1
+        chunk_start = chunk_end = 0
+        chunk = ""
+        for r in prev.regions:
+            begin = r.begin()
+            if begin < end:
+                # overlaps the previous match
+                continue
+            if begin < chunk_start or begin + size > chunk_end:
+                chunk_start = begin
+                chunk_end = begin + max(size, REFINE_CHUNK_SIZE)
+                chunk = view.substr(sublime.Region(chunk_start, chunk_end))
+            text = chunk[begin - chunk_start:begin - chunk_start + size]
+            if (text.lower() if ignore_case else text) == target:
+                region = sublime.Region(begin, begin + size)
+                regions.append(region)
+                end = region.end()
+        return regions
+
+    #
+    # Returns the matches in the visible region, or None if we cannot tell what the closest match is
+    # from just those, i.e., pos is not visible or there is no match after (before) it in the visible
+    # region. We use python regular expressions for this, which for regex searches are not quite the
+    # same as sublime's, so we give up if the pattern doesn't compile. Either way complete_item
+    # replaces these matches with the real ones.
+    #
+    def find_visible(self, pattern, pos):
+        visible = self.view.visible_region()
+        if not visible.contains(pos):
+            return None
+        regex = pattern.get_regex()
+        if regex is None:
+            return None
+        start = visible.begin()
+        regions = [sublime.Region(start + m.start(), start + m.end())
+                   for m in regex.finditer(self.view.substr(visible)) if m.end() > m.start()]
+        if self.find_closest(regions, pos, self.forward) < 0:
+            return None
+        return regions
+
+    #
+    # Find all the matches for an incomplete item on the async thread, and complete it with them back
+    # on the main thread. The status line shows the exact number of matches once that's done. We
+    # don't bother if the item is no longer the current one by the time we get to it - it will be
+    # completed if and when it's needed.
+    #
+    def complete_later(self, si):
+        flags = self.search_flags(si.search)
+
+        def install(regions):
+            if not si.complete and not self.finished:
+                self.complete_item(si, regions)
+                if si is self.current:
+                    self.update()
+
+        def doit():
+            if si is self.current and not self.finished:
+                regions = self.view.find_all(si.search, flags)
+                sublime.set_timeout(lambda: install(regions), 0)
+
+        sublime.set_timeout_async(doit, 0)
+
+    #
+    # Replace the visible matches of an incomplete item with all the matches in the buffer (which are
+    # found now unless they're supplied), keeping the same current match.
+    #
+    def complete_item(self, si, regions=None):
+        if si.complete:
+            return
+        current = si.regions[si.current_index] if si.current_index >= 0 else None
+        if regions is None:
+            regions = self.view.find_all(si.search, self.search_flags(si.search))
+        index = -1
+        if current is not None:
+            index = self.find_closest(regions, current.begin(), True)
+            if index >= 0 and regions[index] != current:
+                index = self.find_closest(regions, current.begin() if si.forward else current.end(), si.forward)
+            if index < 0 or regions[index] != current:
+                # the current match was pushed onto selected when the item was made, so replace it
+                si.selected = si.selected.pop()
+                if index >= 0:
+                    si.selected = si.selected.push(regions[index])
+        si.regions = regions
+        si.current_index = index
+        si.complete = True
+
     #
     # Push a new state onto the stack.
     #
@@ -252,6 +531,7 @@ class ISearchInfo():
     # Pop one state of the stack and restore everything to the state at that time.
     #
     def pop(self, is_group=False):
+        self.flush_change()
         if not self.current.prev:
             return
 
@@ -264,9 +544,11 @@ class ISearchInfo():
             while item.prev and item.group_id == id:
                 item = item.prev
         else:
+            self.materialize(self.current)
             item = self.current.prev
 
         self.current = item
+        self.complete_item(item)
         self.set_text(self.current.search)
         self.forward = self.current.forward
         self.update()
@@ -312,6 +594,9 @@ class ISearchInfo():
         util = self.util
         if not input_panel_hack and info_for(self.view) != self:
             return
+        if not input_panel_hack:
+            self.flush_change()
+        self.finished = True
         if self.current and self.current.search:
             save_search(self.current.search)
         util.set_status("", False)
@@ -326,9 +611,9 @@ class ISearchInfo():
             if current and current.selected:
                 if not current.forward:
                     # put the cursor at the front of the each region
-                    selected = (sublime.Region(s.b, s.a) for s in current.selected)
+                    selected = [sublime.Region(s.b, s.a) for s in current.selected.to_list()]
                 else:
-                    selected = current.selected
+                    selected = current.selected.to_list()
                 selection.add_all(selected)
                 point_set = True
             elif not_in_error and not_in_error.regions:
@@ -348,7 +633,22 @@ class ISearchInfo():
         if not input_panel_hack:
             self.hide_panel()
 
+    #
+    # Schedule a redraw of the matches and status. Searching can call this many times in a row (e.g.,
+    # when appending a word from the buffer) so we make sure we only redraw once per frame.
+    #
     def update(self):
+        if self.redraw_scheduled:
+            return
+        self.redraw_scheduled = True
+        delay = FRAME_TIME - (time.time() - self.last_redraw_time) * 1000
+        sublime.set_timeout(self.redraw, max(0, int(delay)))
+
+    def redraw(self):
+        self.redraw_scheduled = False
+        if self.finished:
+            return
+        self.last_redraw_time = time.time()
         current = self.current
         if current is None:
             return
@@ -369,8 +669,8 @@ class ISearchInfo():
             # erase the error indicator
             self.input_view.add_regions(REGION_FIND, [], "text", "", sublime.DRAW_NO_OUTLINE)
 
-        self.view.add_regions(REGION_FIND, current.regions, "text", "", sublime.DRAW_NO_FILL)
-        selected = current.selected or (not_in_error.selected and [not_in_error.selected[-1]]) or []
+        selected = current.selected.to_list() or (not_in_error.selected and [not_in_error.selected.last()]) or []
+        self.view.add_regions(REGION_FIND, self.get_highlights(current.regions, selected), "text", "", sublime.DRAW_NO_FILL)
         self.view.add_regions(REGION_SELECTED, selected, scope, "", sublime.DRAW_NO_OUTLINE)
         if selected:
             self.view.show(selected[-1])
@@ -381,20 +681,40 @@ class ISearchInfo():
         if self.current.wrapped:
             status += "Wrapped "
         status += "I-Search " + ("Forward" if self.current.forward else "Reverse")
+        matches = pluralize("match", len(current.regions), "es")
+        if not current.complete:
+            # we only have the visible matches so far
+            matches = "%d+ matches" % len(current.regions)
         if current != not_in_error:
             if len(self.current.regions) > 0:
-                status += " %s %s" % (pluralize("match", len(self.current.regions), "es"), ("above" if self.forward else "below"))
+                status += " %s %s" % (matches, ("above" if self.forward else "below"))
         else:
             n_cursors = min(len(current.selected), len(current.regions))
-            status += " %s, %s" % (pluralize("match", len(current.regions), "es"), pluralize("cursor", n_cursors))
+            status += " %s, %s" % (matches, pluralize("cursor", n_cursors))
 
         self.util.set_status(status, False)
 
+    #
+    # Returns the matches to highlight: all of them, or if there are more than isearch_max_highlights,
+    # that many centered on the current match (which is about to be made visible).
+    #
+    def get_highlights(self, regions, selected):
+        limit = isearch_max_highlights
+        if not limit or len(regions) <= limit:
+            return regions
+        pos = selected[-1].begin() if selected else self.view.visible_region().begin()
+        index = self.find_closest(regions, pos, True)
+        if index < 0:
+            index = len(regions)
+        start = max(0, index - limit // 2)
+        return regions[start:start + limit]
+
     #
     # Try to make progress with the current search string. Even if we're currently failing (in our
     # current direction) it doesn't mean there aren't matches for what we've typed so far.
     #
     def next(self, keep, forward=None):
+        self.flush_change()
         if self.current.prev is None:
             # do something special if we invoke "i-search" twice at the beginning
             last_search = get_saved_search()
@@ -403,12 +723,15 @@ class ISearchInfo():
         else:
             if forward is None:
                 forward = self.current.forward
+            self.complete_item(self.current)
             new = self.current.step(forward=forward, keep=keep)
             if new:
                 self.push(new)
             self.update()
 
     def keep_all(self):
+        self.flush_change()
+        self.complete_item(self.current)
         while self.current.regions and self.current.current_index < len(self.current.regions):
             new = self.current.step(forward=self.current.forward, keep=True)
             if new:
@@ -420,6 +743,7 @@ class ISearchInfo():
     def append_from_cursor(self):
         # Figure out the contents to the right of the last region in the current selected state, and
         # append characters from there.
+        self.flush_change()
         si = self.current
         if len(si.search) > 0 and not si.selected:
             # search is failing - no point in adding from current cursor!
@@ -429,7 +753,7 @@ class ISearchInfo():
         limit = view.size()
         if si.selected:
             # grab end of most recent item
-            point = si.selected[-1].end()
+            point = si.selected.last().end()
         else:
             point = self.point[0].b
         if point >= limit:
@@ -456,7 +780,7 @@ class ISearchInfo():
             ch = view.substr(point)
             search += append_one(ch)
             point += 1
-            self.on_change(search)
+            self.apply_change(search)
 
             # If we started on whitespace, and the next character is whitespace, consume all the
             # whitespace. Otherwise, if the next character is a word char, consume that word.
@@ -471,20 +795,21 @@ class ISearchInfo():
                         if ch not in whitespace:
                             break
                         search += append_one(ch)
-                        self.on_change(search)
+                        self.apply_change(search)
                         point += 1
                 else:
                     # now insert word characters
                     while point < limit and helper.is_word_char(point, True, separators):
                         ch = view.substr(point)
                         search += append_one(ch)
-                        self.on_change(search)
+                        self.apply_change(search)
                         point += 1
 
         self.set_text(self.current.search)
         self.in_append_from_cursor = False
 
     def quit(self):
+        self.flush_change()
         close = False
 
         if self.current.regions:
@@ -502,39 +827,48 @@ class ISearchInfo():
         else:
             self.pop()
 
+    #
+    # Returns the index of the closest match at or after pos (forward) or at or before pos (reverse),
+    # or -1 if there isn't one. The regions are sorted and don't overlap, so we can do a binary search.
+    #
     def find_closest(self, regions, pos, forward):
-        #
-        # The regions are sorted so clearly this would benefit from a simple binary search ...
-        #
-        if len(regions) == 0:
-            return -1
-        # find the first region after the specified pos
-        found = False
+        lo = 0
+        hi = len(regions)
         if forward:
-            for index,r in enumerate(regions):
-                if r.end() >= pos:
-                    return index
-            return -1
+            # find the first region which ends at or after pos
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if regions[mid].end() >= pos:
+                    hi = mid
+                else:
+                    lo = mid + 1
+            return lo if lo < len(regions) else -1
         else:
-            for index,r in enumerate(regions):
-                if r.begin() > pos:
-                    return index - 1
-            return len(regions) - 1
+            # find the first region which begins after pos and back up one
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if regions[mid].begin() > pos:
+                    hi = mid
+                else:
+                    lo = mid + 1
+            return lo - 1
 
 class StackItem():
     def __init__(self, search, regions, selected, current_index, forward, wrapped, group_id=None):
         self.prev = None
         self.search = search
         self.regions = regions
-        self.selected = selected
         self.current_index = current_index
         self.forward = forward
         self.try_wrapped = False
         self.wrapped = wrapped
         self.group_id = group_id
+        self.complete = True
+        self.lazy = False
         if current_index >= 0 and regions:
             # add the new one to selected
-            selected.append(regions[current_index])
+            selected = selected.push(regions[current_index])
+        self.selected = selected
 
     def get_point(self):
         if self.current_index >= 0:
@@ -569,7 +903,149 @@ class StackItem():
             wrapped = self.wrapped
         else:
             return None
-        selected = copy(self.selected)
-        if not keep and len(selected) > 0:
-            del(selected[-1])
+        selected = self.selected if keep else self.selected.pop()
         return StackItem(self.search, self.regions, selected, index, forward, wrapped)
+
+#
+# The cursors kept so far in a StackItem. This is an immutable linked list (most recent cursor first)
+# so that each item can share all but its last cursor with the item it was created from. Otherwise
+# each step would copy all the cursors, and "keep all" would be quadratic.
+#
+class Selection():
+    def __init__(self, region=None, parent=None):
+        self.region = region
+        self.parent = parent
+        self.length = parent.length + 1 if parent is not None else 0
+
+    def __len__(self):
+        return self.length
+
+    def push(self, region):
+        return Selection(region, self)
+
+    def pop(self):
+        return self.parent if self.parent is not None else self
+
+    def last(self):
+        return self.region
+
+    #
+    # Returns the cursors as a list, in the order they were added.
+    #
+    def to_list(self):
+        result = []
+        item = self
+        while item.parent is not None:
+            result.append(item.region)
+            item = item.parent
+        result.reverse()
+        return result
+
+#
+# What we know about a search string: the flags to search for it with, whether it's worth searching
+# for at all, and the equivalent python regex (compiled when first needed). These are cached in
+# pattern_cache in least recently used order, since the same strings are searched for over and over
+# again as the user types, deletes and steps through the matches.
+#
+class SearchPattern():
+    def __init__(self, search, regex):
+        self.search = search
+
+        # determine if this is case sensitive search or not
+        flags = 0 if regex else sublime.LITERAL
+        if not re.search(r'[A-Z]', search):
+            flags |= sublime.IGNORECASE
+        self.flags = flags
+        self.valid = not regex or not is_incomplete_regex(search)
+        self.regex = None
+        self.compiled = False
+
+    #
+    # Returns the python regex for this search, or None if there isn't one.
+    #
+    def get_regex(self):
+        if not self.compiled:
+            self.compiled = True
+            if self.valid:
+                pattern = re.escape(self.search) if self.flags & sublime.LITERAL else self.search
+                # sublime matches ^ and $ at the start and end of every line
+                flags = re.MULTILINE
+                if self.flags & sublime.IGNORECASE:
+                    flags |= re.IGNORECASE
+                try:
+                    self.regex = re.compile(pattern, flags)
+                except re.error:
+                    pass
+        return self.regex
+
+# (search, regex) -> SearchPattern
+pattern_cache = OrderedDict()
+
+def get_search_pattern(search, regex):
+    key = (search, regex)
+    pattern = pattern_cache.get(key, None)
+    if pattern is None:
+        pattern = SearchPattern(search, regex)
+        pattern_cache[key] = pattern
+        if len(pattern_cache) > PATTERN_CACHE_SIZE:
+            pattern_cache.popitem(last=False)
+    else:
+        pattern_cache.move_to_end(key)
+    return pattern
+
+#
+# Returns True if the specified regex is obviously not finished yet: it ends with a backslash, has
+# unbalanced parentheses or an unterminated character class, or starts (or starts a group or an
+# alternative) with a quantifier. This is not a full syntax check - it just catches the usual states
+# a regex is in while it's being typed, so we don't ask sublime to search the buffer for them.
+#
+def is_incomplete_regex(pattern):
+    n = len(pattern)
+    depth = 0
+    atom = False
+    i = 0
+    while i < n:
+        ch = pattern[i]
+        if ch == '\\':
+            if i + 1 == n:
+                return True
+            i += 1
+            atom = True
+        elif ch == '[':
+            # a "]" right after the "[" or "[^" is part of the class
+            i += 1
+            if i < n and pattern[i] == '^':
+                i += 1
+            if i < n and pattern[i] == ']':
+                i += 1
+            while i < n and pattern[i] != ']':
+                if pattern[i] == '\\':
+                    i += 1
+                i += 1
+            if i >= n:
+                return True
+            atom = True
+        elif ch == '(':
+            depth += 1
+            atom = False
+            if i + 1 < n and pattern[i + 1] == '?':
+                # an extension like (?: or (?i), not a quantifier
+                i += 1
+        elif ch == ')':
+            depth -= 1
+            if depth < 0:
+                return True
+            atom = True
+        elif ch == '|' or ch == '^':
+            atom = False
+        elif ch in "*+?":
+            if not atom:
+                return True
+            if i + 1 < n and pattern[i + 1] in "?+":
+                # lazy or possessive
+                i += 1
+            atom = False
+        else:
+            atom = True
+        i += 1
+    return depth != 0
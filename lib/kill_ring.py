@@ -1,24 +1,78 @@
-import re
+import re, time, os, mmap, tempfile, struct, zlib, hashlib
+from collections import deque
 import sublime, sublime_plugin
-from .misc import SettingsHelper
+from .misc import SettingsHelper, get_cache_dir
 
 # initialized below
 kill_ring_size = kill_index = pop_index = entries = None
+max_bytes = spill_bytes = None
+persist = True
+
+SPILL_DIR = "kills"
+
+# The kill ring is saved in this file (in the cache directory) SAVE_DELAY milliseconds after it
+# changes, and when the plugin is unloaded. It's loaded the first time it's used.
+RING_FILE = "kill_ring.bin"
+RING_MAGIC = b"SBPK\x02"
+SAVE_DELAY = 2000
+loaded = False
+pending_save_time = None
+
+# Samples are made from at most this many characters (or bytes, for spilled entries) from each end of
+# the first region, or 4 times the width of the sample if that's more.
+SAMPLE_WINDOW = 1000
+
+# The clipboard is updated once kills have stopped for this many milliseconds, rather than on every
+# kill, since that means joining all the text of the entry being built up by a series of kills.
+CLIPBOARD_SYNC_DELAY = 200
+
+# the kill which needs to be copied to the clipboard, and when that was last requested
+pending_clipboard = None
+pending_clipboard_time = 0
+
+# (length, hash) of the text we last put on the clipboard
+last_clipboard = None
+
+# Content key -> Kill, so that adding something which is already in the ring just moves it to the
+# front. Joined kills don't know their key until it's needed, and are kept in unkeyed until then.
+key_index = dict()
+unkeyed = set()
+
+# Kills with no more text than this are indexed by their (lower case) trigrams for searching. Bigger
+# ones are just scanned. The index isn't counted against max_bytes, and on text with lots of distinct
+# trigrams (base64, minified code) it can be several times the size of the text, so this is small.
+TRIGRAM_INDEX_LIMIT = 64 * 1024
+
+# trigram -> set of Kills, and Kill -> its trigrams (None for kills which are too big to index)
+trigram_index = dict()
+kill_trigrams = dict()
 
 #
 # Called from JOVE when the plugin has loaded.
 #
 def initialize():
-    global kill_ring, kill_ring_size, kill_index, pop_index, entries
+    global kill_ring, kill_ring_size, kill_index, pop_index, entries, max_bytes, spill_bytes, persist
 
     settings_helper = SettingsHelper()
 
     # kill ring size - default 64 entries
     kill_ring_size = settings_helper.get("sbp_kill_ring_size", 64)
 
+    # total size of the text we keep in memory, and the size above which entries are kept on disk
+    max_bytes = settings_helper.get("sbp_kill_ring_max_bytes", 64 * 1024 * 1024)
+    spill_bytes = settings_helper.get("sbp_kill_ring_spill_bytes", 1024 * 1024)
+
+    # whether the kill ring is saved across restarts
+    persist = settings_helper.get("sbp_kill_ring_persist", True)
+
     entries = [None] * kill_ring_size
     kill_index = 0
 
+def get_spill_dir():
+    path = os.path.join(get_cache_dir(), SPILL_DIR)
+    os.makedirs(path, exist_ok=True)
+    return path
+
 #
 # Add some text to the kill ring. 'forward' indicates whether the editing command that produced
 # this data was in the forward or reverse direction. It only matters if 'join' is true, because
@@ -28,48 +82,232 @@ def initialize():
 def add(regions, forward, join):
     global kill_index
 
+    ensure_loaded()
     total_bytes = sum((len(c) for c in regions))
 
     if total_bytes == 0:
         return
     try:
-        if not join:
-            # if the current item is the same as what we're trying to kill, don't bother
-            if entries[kill_index] and entries[kill_index].same_as(regions):
-                return
-        else:
+        if join:
             # try to join
-            if entries[kill_index] and entries[kill_index].join_if_possible(regions, forward):
+            kill = entries[kill_index]
+            if kill and kill.moved:
+                # This entry was made earlier and only moved to the front because it was killed
+                # again, so leave it alone and add the joined text as a new entry.
+                if len(regions) == kill.n_regions:
+                    regions = [old + new if forward else new + old for old, new in zip(kill.regions, regions)]
+            elif kill and kill.join_if_possible(regions, forward):
+                forget_key(kill)
+                unkeyed.add(kill)
+                unindex_trigrams(kill)
                 return
 
+        # if this is already in the ring, move it to the front rather than adding it again
+        key = content_key(regions)
+        kill = find_key(key)
+        if kill is not None:
+            move_to_front(kill)
+            kill.moved = True
+            return
+
         # create the new entry
         kill_index = (kill_index + 1) % kill_ring_size
-        entries[kill_index] = Kill(regions)
+        drop_entry(kill_index)
+        kill = entries[kill_index] = Kill(regions)
+        kill.key = key
+        key_index[key] = kill
+        enforce_budget()
     finally:
         set_current(kill_index)
 
 #
-# Returns a sample of the first region of each entry in the kill ring, so that it can be
-# displayed to the user to allow them to choose it. The sample is truncated unfortunately.
+# Returns the kill in the ring with the specified content key, if any.
 #
-def get_popup_sample(view):
-    add_external_clipboard()
+def find_key(key):
+    while unkeyed:
+        kill = unkeyed.pop()
+        if kill in entries:
+            kill.key = kill.get_key()
+            key_index[kill.key] = kill
+    return key_index.get(key, None)
+
+def forget_key(kill):
+    if kill.key is not None:
+        if key_index.get(kill.key, None) is kill:
+            del(key_index[kill.key])
+        kill.key = None
 
+#
+# Make the specified kill the current one, moving the ones in front of it back one place.
+#
+def move_to_front(kill):
+    index = entries.index(kill)
+    while index != kill_index:
+        next = (index + 1) % kill_ring_size
+        entries[index] = entries[next]
+        index = next
+    entries[kill_index] = kill
+
+#
+# Remove the entry at the specified index from the ring, if there is one.
+#
+def drop_entry(index):
+    kill = entries[index]
+    if kill:
+        kill.release()
+        forget_key(kill)
+        unkeyed.discard(kill)
+        unindex_trigrams(kill)
+        entries[index] = None
+
+#
+# Keep the text of the kill ring within max_bytes. Large entries other than the current one (which
+# might still be added to) are spilled to disk, and if that's not enough, the oldest entries are
+# dropped. Spilling happens on the async thread, and entries being spilled no longer count against
+# the budget.
+#
+def enforce_budget():
+    current = entries[kill_index]
+    total = 0
+    for entry in entries:
+        if entry and not entry.is_spilled():
+            if entry is not current and entry.size >= spill_bytes:
+                entry.spill()
+            else:
+                total += entry.size
+
+    index = (kill_index + 1) % kill_ring_size
+    while total > max_bytes and index != kill_index:
+        entry = entries[index]
+        if entry and not entry.is_spilled():
+            total -= entry.size
+            drop_entry(index)
+        index = (index + 1) % kill_ring_size
+
+#
+# Returns (number of entries, bytes in memory, number of entries on disk, bytes on disk).
+#
+def memory_usage():
+    ensure_loaded()
+    n_entries = in_memory = n_spilled = spilled = 0
+    for entry in entries:
+        if entry:
+            n_entries += 1
+            if entry.is_spilled():
+                n_spilled += 1
+                spilled += entry.size
+            else:
+                in_memory += entry.size
+    return n_entries, in_memory, n_spilled, spilled
+
+#
+# Returns a sample of the first region of each entry in the kill ring (or just the entries with the
+# specified indexes), so that it can be displayed to the user to allow them to choose it. The sample
+# is truncated unfortunately.
+#
+def get_popup_sample(view, indexes=None):
+    ensure_loaded()
+    if indexes is not None:
+        return [(index, entries[index].get_sample(view)) for index in indexes]
+
+    add_external_clipboard()
     index = kill_index
     result = []
-    seen = {}
     while True:
         kill = entries[index]
         if kill:
-            text = kill.get_sample(view)
-            if text not in seen:
-                result.append((index, text))
-                seen[text] = True
+            result.append((index, kill.get_sample(view)))
+        index = (index - 1) % kill_ring_size
+        if index == kill_index:
+            break
+    return result
+
+#
+# Returns the indexes of the entries which contain query anywhere in their text (not just in the
+# sample), most recent first, or None if query is not a valid regex. As with i-search, the search is
+# case sensitive only if the query contains upper case characters.
+#
+# Literal queries of at least 3 characters are looked up in the trigram index, so that only the
+# entries which contain all the trigrams in the query (plus any which are too big to index) are
+# actually checked. Regex and shorter queries check every entry.
+#
+def search(query, regex=False):
+    ensure_loaded()
+    add_external_clipboard()
+    ignore_case = not re.search(r'[A-Z]', query)
+    if regex:
+        try:
+            pattern = re.compile(query, re.IGNORECASE if ignore_case else 0)
+        except re.error:
+            return None
+    elif ignore_case:
+        query = query.lower()
+
+    # Literal queries are looked for in the files of spilled entries without reading them in. This
+    # works a byte at a time, so a case insensitive query must be plain ascii.
+    spilled_pattern = None
+    if not regex and "\n" not in query:
+        try:
+            data = query.encode("ascii" if ignore_case else "utf-8")
+            spilled_pattern = re.compile(re.escape(data), re.IGNORECASE if ignore_case else 0)
+        except UnicodeEncodeError:
+            pass
+
+    candidates = None
+    if not regex and len(query) >= 3:
+        index_trigrams()
+        postings = sorted((trigram_index.get(trigram, ()) for trigram in get_trigrams(query.lower())), key=len)
+        candidates = set(postings[0]).intersection(*postings[1:])
+        candidates.update(kill for kill, trigrams in kill_trigrams.items() if trigrams is None)
+
+    result = []
+    index = kill_index
+    while True:
+        kill = entries[index]
+        if kill and (candidates is None or kill in candidates):
+            if spilled_pattern is not None and kill.is_spilled():
+                found = kill.search_spilled(spilled_pattern)
+            elif regex:
+                found = pattern.search("\n".join(kill.regions)) is not None
+            else:
+                text = "\n".join(kill.regions)
+                found = query in (text.lower() if ignore_case else text)
+            if found:
+                result.append(index)
         index = (index - 1) % kill_ring_size
         if index == kill_index:
             break
     return result
 
+def get_trigrams(text):
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+#
+# Index the trigrams of the entries which haven't been indexed yet.
+#
+def index_trigrams():
+    for kill in entries:
+        if kill and kill not in kill_trigrams:
+            if kill.size > TRIGRAM_INDEX_LIMIT:
+                kill_trigrams[kill] = None
+                continue
+            trigrams = get_trigrams("\n".join(kill.regions).lower())
+            kill_trigrams[kill] = trigrams
+            for trigram in trigrams:
+                kills = trigram_index.get(trigram, None)
+                if kills is None:
+                    kills = trigram_index[trigram] = set()
+                kills.add(kill)
+
+def unindex_trigrams(kill):
+    trigrams = kill_trigrams.pop(kill, None)
+    if trigrams:
+        for trigram in trigrams:
+            kills = trigram_index[trigram]
+            kills.discard(kill)
+            if not kills:
+                del(trigram_index[trigram])
+
 #
 # Sets the current kill ring index. Normally this is managed within this file, but choose and yank
 # sets the index to the chosen index from the overlay.
@@ -77,20 +315,54 @@ def get_popup_sample(view):
 def set_current(index):
     global kill_index
 
+    ensure_loaded()
     if entries[index]:
         kill_index = index
-        entries[index].set_clipboard()
+        schedule_clipboard(entries[index])
+        schedule_save()
+
+#
+# Arrange for the clipboard to be set to the specified kill, once things have settled down.
+#
+def schedule_clipboard(kill):
+    global pending_clipboard, pending_clipboard_time
+
+    if pending_clipboard is None:
+        sublime.set_timeout(on_clipboard_timeout, CLIPBOARD_SYNC_DELAY)
+    pending_clipboard = kill
+    pending_clipboard_time = time.time()
+
+def on_clipboard_timeout():
+    if pending_clipboard is None:
+        return
+    remaining = CLIPBOARD_SYNC_DELAY - int((time.time() - pending_clipboard_time) * 1000)
+    if remaining > 0:
+        sublime.set_timeout(on_clipboard_timeout, remaining)
+    else:
+        flush_clipboard()
+
+#
+# Set the clipboard now if it's out of date. This must be called before looking at the clipboard.
+#
+def flush_clipboard():
+    global pending_clipboard
+
+    kill = pending_clipboard
+    if kill is not None:
+        pending_clipboard = None
+        kill.set_clipboard()
 
 #
 # Add the external clipboard to the kill ring, if appropriate. And return it if we do.
 #
 def add_external_clipboard():
     # first check to see whether we bring in the clipboard
+    flush_clipboard()
     index = kill_index
     entry = entries[index]
     clipboard = sublime.get_clipboard()
 
-    if clipboard and (entry is None or not entry.matches_clipboard()):
+    if clipboard and not is_last_clipboard(clipboard) and (entry is None or not entry.matches_clipboard(clipboard)):
         # We switched to another app and cut or copied something there, so add the clipboard
         # to our kill ring.
         result = [clipboard]
@@ -98,6 +370,15 @@ def add_external_clipboard():
         return result
     return None
 
+#
+# Returns True if clipboard is (almost certainly) the text we last put on the clipboard. The length
+# check takes care of most changes, and hashing is much cheaper than comparing the text region by
+# region.
+#
+def is_last_clipboard(clipboard):
+    return (last_clipboard is not None and last_clipboard[0] == len(clipboard) and
+            last_clipboard[1] == hash(clipboard))
+
 #
 # Returns the current entry in the kill ring for the purposes of yanking. If pop is non-zero, we
 # move backwards or forwards once in the kill ring and return that data instead. If the number
@@ -110,6 +391,7 @@ def add_external_clipboard():
 def get_current(n_regions, pop, index):
     global pop_index
 
+    ensure_loaded()
     clipboard = result = None
     if pop == 0:
         if index is None:
@@ -134,7 +416,7 @@ def get_current(n_regions, pop, index):
 
         pop_index = index
         result = entries[index].regions
-        entries[index].set_clipboard()
+        schedule_clipboard(entries[index])
 
     # Make sure we have enough data for the specified number of regions, duplicating regions until
     # we meet the requested number of cursors. Special case of 1 request region with multiple kill
@@ -145,73 +427,255 @@ def get_current(n_regions, pop, index):
                 result = ["\n".join(result)]
             else:
                 while len(result) < n_regions:
-                    result *= 2
+                    result = result * 2
             return result[0:n_regions]
         return result
     return None
 
+#
+# A single kill (maybe with multiple cursors). Each region is kept as a deque of the chunks of text
+# that were killed to make it, so that joining a long series of kills (e.g., holding down ctrl+k) is
+# linear rather than quadratic. The text of the regions is only put together when someone asks for it
+# (yank, clipboard, sample), and it's remembered until the next join.
+#
+# Large kills can be spilled to a file, in which case we keep just the length (in bytes) of each
+# region and read the text back (by memory-mapping the file) when it's needed. The text we read is
+# kept until the current operation is over, so that, e.g., yanking reads the file once even though it
+# also checks and sets the clipboard. Size is the number of characters in the kill, which is what we
+# count against the memory budget.
+#
 class Kill(object):
-    """A single kill (maybe with multiple cursors)"""
     def __init__(self, regions):
-        self.regions = regions
+        self.chunks = [deque([region]) for region in regions]
+        self.joined = list(regions)
         self.n_regions = len(regions)
+        self.size = sum(len(region) for region in regions)
+        self.path = self.lengths = None
+        self.sample = None
+        self.version = 0
+        self.key = None
+        self.spilling = False
+
+        # True if we've been moved to the front of the ring by adding our text again, in which case
+        # joins make a new entry rather than changing us
+        self.moved = False
+
+    @property
+    def regions(self):
+        if self.chunks is None:
+            if self.joined is None:
+                self.joined = self.read_spilled()
+                sublime.set_timeout(self.forget_spilled_text, 0)
+            return self.joined
+        if self.joined is None:
+            self.joined = ["".join(chunks) for chunks in self.chunks]
+            self.chunks = [deque([region]) for region in self.joined]
+        return self.joined
 
     # Joins a set of regions with our existing set, if possible. We must have
     # the same number of regions.
     def join_if_possible(self, regions, forward):
         if len(regions) != self.n_regions:
             return False
-        for i, c in enumerate(regions):
+        if self.chunks is None:
+            self.unspill()
+
+        # our file (if any) won't match our text any more
+        self.release()
+        for chunks, region in zip(self.chunks, regions):
             if forward:
-                self.regions[i] += regions[i]
+                chunks.append(region)
             else:
-                self.regions[i] = regions[i] + self.regions[i]
+                chunks.appendleft(region)
+        self.joined = self.sample = None
+        self.size += sum(len(region) for region in regions)
+        self.version += 1
         return True
 
+    #
+    # Returns the content key for our text, reading it from our file if we have to.
+    #
+    def get_key(self):
+        if self.key is not None:
+            return self.key
+        if not self.is_spilled():
+            return content_key(self.regions)
+        key = hashlib.sha1()
+        try:
+            with open(self.path, "rb") as f:
+                if sum(self.lengths) == 0:
+                    data = b""
+                else:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                offset = 0
+                for length in self.lengths:
+                    key.update(struct.pack("<Q", length))
+                    key.update(data[offset:offset + length])
+                    offset += length
+                if data:
+                    data.close()
+        except (IOError, OSError, ValueError) as e:
+            print("Error reading spilled kill", e)
+        return key.digest()
+
+    #
+    # Returns True if our text is only in our file. We can also have a file while our text is in
+    # memory, e.g., if we've been yanked since we were spilled.
+    #
+    def is_spilled(self):
+        return self.chunks is None
+
+    #
+    # Forget our text if we have a file with it in. If we don't have a file yet, one is written on
+    # the async thread, and we forget our text once we've adopted it (see spill_async).
+    #
+    def spill(self):
+        if self.path is not None:
+            self.chunks = self.joined = None
+        elif not self.spilling:
+            self.spilling = True
+            spill_async(self)
+
+    def forget_spilled_text(self):
+        if self.chunks is None:
+            self.joined = None
+
+    #
+    # Returns the (start, end) byte range of each of our regions in our file.
+    #
+    def get_ranges(self):
+        ranges = []
+        offset = 0
+        for length in self.lengths:
+            ranges.append((offset, offset + length))
+            offset += length
+        return ranges
+
+    #
+    # Read the text of our regions back from our file, or just the specified (start, end) byte
+    # ranges of it. Ranges which might split a character should pass errors="ignore".
+    #
+    def read_spilled(self, ranges=None, errors="strict"):
+        if ranges is None:
+            ranges = self.get_ranges()
+        result = []
+        try:
+            with open(self.path, "rb") as f:
+                if sum(self.lengths) == 0:
+                    return [""] * len(ranges)
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    for start, end in ranges:
+                        result.append(data[start:end].decode("utf-8", errors))
+        except (IOError, OSError, ValueError) as e:
+            print("Error reading spilled kill", e)
+            return []
+        return result
+
+    #
+    # Returns True if the specified bytes pattern matches any of our regions in our file.
+    #
+    def search_spilled(self, pattern):
+        if sum(self.lengths) == 0:
+            return False
+        try:
+            with open(self.path, "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    for start, end in self.get_ranges():
+                        if pattern.search(data, start, end) is not None:
+                            return True
+        except (IOError, OSError, ValueError) as e:
+            print("Error reading spilled kill", e)
+        return False
+
+    #
+    # Bring our text back into memory.
+    #
+    def unspill(self):
+        if self.joined is None:
+            self.joined = self.read_spilled()
+        self.chunks = [deque([region]) for region in self.joined]
+
+    #
+    # Called when we're leaving the kill ring, or our file is no longer needed.
+    #
+    def release(self):
+        if self.path is not None:
+            remove_file(self.path)
+            self.path = self.lengths = None
+
     #
     # Get a sample from the first cursor. This is trickier than it seems because we don't like the
     # way sublime samples the string when displaying it, so we need to try to make sure it fits on
     # the screen or at least comes close. We pass in the view to get the current approximate width
     # of the screen in characters.
     #
+    # The sample only depends on the text and the width, so we remember it until either of those
+    # changes, and we only look at the two ends of the text, so that long kills cost no more than
+    # short ones.
+    #
     def get_sample(self, view):
         # approximate number of chars we can show
-        max_chars = (view.viewport_extent()[0] / view.em_width()) * .9
-        text = self.regions[0]
-        n_regions = len(self.regions)
-
-        # stripe newlines, spaces and tabs from the beginning and end
-        text = text.strip("\n \t")
-
-        # collapse multiple newlines into a single and convert to a glyph
-        # text = re.sub("\n+", "↩", text)
-        # text = re.sub("\n+", "\u23ce", text)
-        text = re.sub("\n+", "\u00b6", text)
-
-        # replace multiple white space with single spaces within the string
-        text = re.sub("\\s\\s+", " ", text)
-
-        # truncate if necessary
-        if len(text) > max_chars:
-            half = int(max_chars / 2)
-            text = text[:half] + "\u27FA" + text[-half:] + "   "
-
-        if n_regions > 1:
-            text = "[%d]: %s" % (n_regions, text)
+        max_chars = int((view.viewport_extent()[0] / view.em_width()) * .9)
+        if self.sample is not None and self.sample[0] == max_chars:
+            return self.sample[1]
+
+        half = int(max_chars / 2)
+        head, tail = self.get_ends(max(SAMPLE_WINDOW, 4 * max_chars))
+        if tail is None:
+            # stripe newlines, spaces and tabs from the beginning and end
+            text = clean_sample(head.strip("\n \t"))
+
+            # truncate if necessary
+            if len(text) > max_chars:
+                text = text[:half] + "\u27FA" + text[-half:] + "   "
+        else:
+            # always truncated
+            head = clean_sample(head.lstrip("\n \t"))
+            tail = clean_sample(tail.rstrip("\n \t"))
+            text = head[:half] + "\u27FA" + tail[-half:] + "   "
+
+        if self.n_regions > 1:
+            text = "[%d]: %s" % (self.n_regions, text)
+        self.sample = (max_chars, text)
         return text
 
+    #
+    # Returns the first region as (text, None) if it's no longer than 2 * window, or the (head, tail)
+    # windows at each end of it.
+    #
+    def get_ends(self, window):
+        if not self.is_spilled():
+            text = self.regions[0]
+            if len(text) <= 2 * window:
+                return text, None
+            return text[:window], text[-window:]
+
+        length = self.lengths[0]
+        if length <= 2 * window:
+            ends = self.read_spilled([(0, length)])
+            return (ends[0] if ends else ""), None
+        ends = self.read_spilled([(0, window), (length - window, length)], errors="ignore")
+        if not ends:
+            return "", None
+        return ends[0], ends[1]
+
     #
     # We set the clipboard to the concatenation of all the regions with "\n" like Sublime already
     # did.
     #
     def set_clipboard(self):
-        sublime.set_clipboard("\n".join(self.regions))
+        global last_clipboard
+
+        text = "\n".join(self.regions)
+        sublime.set_clipboard(text)
+        last_clipboard = (len(text), hash(text))
 
     #
-    # Returns true if this region matches the current external clipboard.
+    # Returns true if this region matches the specified clipboard text.
     #
-    def matches_clipboard(self):
-        clipboard = sublime.get_clipboard()
+    def matches_clipboard(self, clipboard):
+        if len(clipboard) != self.size + self.n_regions - 1:
+            return False
         offset = 0
         for region in self.regions:
             length = len(region)
@@ -221,10 +685,279 @@ class Kill(object):
             offset += length + 1
         return offset >= len(clipboard)
 
-    def same_as(self, regions):
-        if len(regions) != self.n_regions:
-            return False
-        for me, him in zip(regions, self.regions):
-            if me != him:
-                return False
-        return True
+#
+# Returns a digest of the specified regions, which identifies a kill's contents.
+#
+def content_key(regions):
+    key = hashlib.sha1()
+    for region in regions:
+        data = region.encode("utf-8")
+        key.update(struct.pack("<Q", len(data)))
+        key.update(data)
+    return key.digest()
+
+#
+# Returns a Kill whose text is in the specified file.
+#
+def spilled_kill(path, lengths, size):
+    kill = Kill([])
+    kill.chunks = kill.joined = None
+    kill.n_regions = len(lengths)
+    kill.size = size
+    kill.path = path
+    kill.lengths = lengths
+    return kill
+
+#
+# Write the text of the specified kill to a file on the async thread, and give the kill the file
+# back on the main thread. The kill forgets its text then, unless it has changed or become the
+# current entry in the meantime. We join the chunks on the async thread too, which is safe because
+# joins only add chunks to the current entry, and we take a copy of the chunk lists.
+#
+def spill_async(kill):
+    version = kill.version
+    chunks = [list(region) for region in kill.chunks]
+
+    def adopt(saved):
+        kill.spilling = False
+        if saved is None:
+            return
+        adopt_files([(kill, version) + saved])
+        if kill.path == saved[0] and kill is not entries[kill_index]:
+            kill.chunks = kill.joined = None
+
+    def write():
+        saved = write_kill_file(["".join(region) for region in chunks])
+        sublime.set_timeout(lambda: adopt(saved), 0)
+    sublime.set_timeout_async(write, 0)
+
+#
+# Write the specified regions to a new file in the spill directory, and return (path, lengths) where
+# lengths is the length of each region in bytes, or None if that fails.
+#
+def write_kill_file(regions):
+    data = [region.encode("utf-8") for region in regions]
+    fd, path = tempfile.mkstemp(suffix=".kill", dir=get_spill_dir())
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for item in data:
+                f.write(item)
+    except (IOError, OSError) as e:
+        print("Error spilling kill", e)
+        remove_file(path)
+        return None
+    return path, [len(item) for item in data]
+
+#
+# Collapse the white space in some text for a sample.
+#
+def clean_sample(text):
+    # collapse multiple newlines into a single and convert to a glyph
+    # text = re.sub("\n+", "↩", text)
+    # text = re.sub("\n+", "\u23ce", text)
+    text = re.sub("\n+", "\u00b6", text)
+
+    # replace multiple white space with single spaces within the string
+    return re.sub("\\s\\s+", " ", text)
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+#
+# Persistence. The ring file is RING_MAGIC followed by the zlib compressed entries, oldest first
+# (so the last one is the current one). Each entry is its content key (if known) and either its
+# regions, as length-prefixed utf-8 strings, or, for large entries, a reference to the spill file
+# holding its text, so that loading the ring never reads those.
+#
+
+def ensure_loaded():
+    global loaded
+    if not loaded:
+        loaded = True
+        if persist:
+            load_ring()
+        else:
+            remove_saved_ring()
+
+#
+# Remove the saved ring and the spill files left over from before, for when we're not saving the
+# ring. (This session's large entries are still spilled to files.)
+#
+def remove_saved_ring():
+    remove_file(os.path.join(get_cache_dir(), RING_FILE))
+    spill_dir = get_spill_dir()
+    for name in os.listdir(spill_dir):
+        remove_file(os.path.join(spill_dir, name))
+
+def load_ring():
+    global kill_index
+
+    path = os.path.join(get_cache_dir(), RING_FILE)
+    spill_dir = get_spill_dir()
+    kills = []
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        if data.startswith(RING_MAGIC):
+            kills = unpack_ring(zlib.decompress(data[len(RING_MAGIC):]), spill_dir)
+    except FileNotFoundError:
+        pass
+    except (IOError, OSError, ValueError, struct.error, zlib.error) as e:
+        print("Error loading kill ring", e)
+
+    for kill in kills:
+        kill_index = (kill_index + 1) % kill_ring_size
+        drop_entry(kill_index)
+        entries[kill_index] = kill
+        if kill.key is not None:
+            key_index[kill.key] = kill
+        else:
+            unkeyed.add(kill)
+
+    # remove the spill files which are no longer referenced
+    referenced = set(os.path.basename(kill.path) for kill in entries if kill and kill.path)
+    for name in os.listdir(spill_dir):
+        if name not in referenced:
+            remove_file(os.path.join(spill_dir, name))
+
+def unpack_ring(data, spill_dir):
+    kills = []
+    offset = 0
+    n_kills, = struct.unpack_from("<I", data, offset)
+    offset += 4
+    for i in range(n_kills):
+        kind, n_regions, key_length = struct.unpack_from("<BIB", data, offset)
+        offset += 6
+        key = data[offset:offset + key_length] or None
+        offset += key_length
+        if kind == 0:
+            regions = []
+            for j in range(n_regions):
+                length, = struct.unpack_from("<I", data, offset)
+                offset += 4
+                regions.append(data[offset:offset + length].decode("utf-8"))
+                offset += length
+            kill = Kill(regions)
+        else:
+            size, name_length = struct.unpack_from("<QH", data, offset)
+            offset += 10
+            name = data[offset:offset + name_length].decode("utf-8")
+            offset += name_length
+            lengths = list(struct.unpack_from("<%dQ" % n_regions, data, offset))
+            offset += 8 * n_regions
+            path = os.path.join(spill_dir, name)
+            if not os.path.exists(path):
+                continue
+            kill = spilled_kill(path, lengths, size)
+        kill.key = key
+        kills.append(kill)
+    return kills
+
+#
+# Arrange for the ring to be saved once it stops changing.
+#
+def schedule_save():
+    global pending_save_time
+
+    if not persist:
+        return
+    if pending_save_time is None:
+        sublime.set_timeout(on_save_timeout, SAVE_DELAY)
+    pending_save_time = time.time()
+
+def on_save_timeout():
+    global pending_save_time
+
+    if pending_save_time is None:
+        return
+    remaining = SAVE_DELAY - int((time.time() - pending_save_time) * 1000)
+    if remaining > 0:
+        sublime.set_timeout(on_save_timeout, remaining)
+    else:
+        pending_save_time = None
+        snapshot = snapshot_ring()
+
+        def save():
+            written = save_ring(snapshot)
+            sublime.set_timeout(lambda: adopt_files(written), 0)
+        sublime.set_timeout_async(save, 0)
+
+#
+# Save the ring right now if it has changed. Called when the plugin is unloaded.
+#
+def flush_save():
+    global pending_save_time
+
+    if pending_save_time is not None:
+        pending_save_time = None
+        adopt_files(save_ring(snapshot_ring()))
+
+#
+# Returns the (kill, version, size, key, regions, path, lengths) for each entry in the ring, oldest
+# first, where regions is None if the entry is to be saved by reference and already has a file.
+#
+def snapshot_ring():
+    result = []
+    for i in range(kill_ring_size):
+        kill = entries[(kill_index + 1 + i) % kill_ring_size]
+        if not kill:
+            continue
+        if kill.path is not None:
+            result.append((kill, kill.version, kill.size, kill.key, None, kill.path, kill.lengths))
+        else:
+            result.append((kill, kill.version, kill.size, kill.key, kill.regions, None, None))
+    return result
+
+#
+# Write the ring file for the specified snapshot. This may be called on the async thread, so it
+# doesn't touch the kills themselves. Large entries which don't have a file yet are written to one,
+# and the (kill, version, path, lengths) for those are returned so that the kills can adopt them.
+#
+def save_ring(snapshot):
+    written = []
+    out = [struct.pack("<I", len(snapshot))]
+    for kill, version, size, key, regions, path, lengths in snapshot:
+        key = key or b""
+        if path is None and size >= spill_bytes:
+            saved = write_kill_file(regions)
+            if saved is not None:
+                path, lengths = saved
+                written.append((kill, version, path, lengths))
+        if path is None:
+            out.append(struct.pack("<BIB", 0, len(regions), len(key)))
+            out.append(key)
+            for region in regions:
+                data = region.encode("utf-8")
+                out.append(struct.pack("<I", len(data)))
+                out.append(data)
+        else:
+            name = os.path.basename(path).encode("utf-8")
+            out.append(struct.pack("<BIB", 1, len(lengths), len(key)))
+            out.append(key)
+            out.append(struct.pack("<QH", size, len(name)))
+            out.append(name)
+            out.append(struct.pack("<%dQ" % len(lengths), *lengths))
+
+    path = os.path.join(get_cache_dir(), RING_FILE)
+    try:
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(RING_MAGIC)
+            f.write(zlib.compress(b"".join(out)))
+        os.replace(tmp, path)
+    except (IOError, OSError) as e:
+        print("Error saving kill ring", e)
+    return written
+
+#
+# Give the kills the files that were written for them while saving, unless they have changed since.
+#
+def adopt_files(written):
+    for kill, version, path, lengths in written:
+        if kill.version == version and kill.path is None and kill in entries:
+            kill.path, kill.lengths = path, lengths
+        else:
+            remove_file(path)
@@ -1,3 +1,5 @@
+from collections import deque
+
 import sublime, sublime_plugin
 
 #
@@ -8,41 +10,111 @@ import sublime, sublime_plugin
 #
 # Each entry is an array of 1 or more regions.
 #
+# There is one mark ring per buffer, shared by all the views of that buffer. The named regions live
+# in one of those views (the owner), and move to another one if the owner is closed. We keep a copy
+# of the current mark in python, which is only good for the buffer's change count when we made it,
+# and we keep track of which entries are in use, so most operations don't need to ask sublime
+# anything more than the change count.
+#
 class MarkRing:
-    MARK_RING_SIZE = 16
+    # buffer_id -> MarkRing
+    rings = dict()
+
+    #
+    # Returns the mark ring for the specified view's buffer, creating it if necessary.
+    #
+    @classmethod
+    def for_view(cls, view):
+        ring = cls.rings.get(view.buffer_id(), None)
+        if ring is None:
+            ring = cls.rings[view.buffer_id()] = MarkRing(view)
+        else:
+            ring.add_view(view)
+        return ring
 
     def __init__(self, view):
+        from .misc import SettingsHelper
+
         self.view = view
+        self.views = [view]
+        self.buffer_id = view.buffer_id()
+        self.size = SettingsHelper().get("sbp_mark_ring_size", 16)
         self.index = 0
 
-        # in case any left over from before
+        # the indexes of the entries we have set, the current mark (None if we need to fetch it) and
+        # the change count it's good for, and the (index, regions) being displayed, if any
+        self.used = set()
+        self.global_keys = set()
+        self.current = None
+        self.current_change_count = None
+        self.displayed = None
+
+        # in case any left over from before (other left over entries are never used)
         self.view.erase_regions("jove_mark")
-        for i in range(self.MARK_RING_SIZE):
-            self.view.erase_regions(self.get_key(i))
 
     def get_key(self, index):
         return "jove_mark:" + str(index)
 
+    def add_view(self, view):
+        self.views.append(view)
+        if self.displayed is not None:
+            view.add_regions("jove_mark", self.displayed[1], "mark", "dot", sublime.HIDDEN)
+
+    #
+    # Called when one of our views is about to close. If it's the owner, the marks move to one of
+    # the other views, and if it's the last one, the ring goes away.
+    #
+    def remove_view(self, view):
+        self.views = [v for v in self.views if v.id() != view.id()]
+        if view.id() != self.view.id():
+            return
+        if not self.views:
+            if MarkRing.rings.get(self.buffer_id, None) is self:
+                del(MarkRing.rings[self.buffer_id])
+            return
+        owner = self.views[0]
+        keys = [self.get_key(index) for index in self.used] + list(self.global_keys)
+        for key in keys:
+            owner.add_regions(key, view.get_regions(key), "mark", "", sublime.HIDDEN)
+        self.view = owner
+
     def clear(self):
-        self.view.erase_regions("jove_mark")
+        if self.displayed is not None:
+            for view in self.views:
+                view.erase_regions("jove_mark")
+            self.displayed = None
 
     def has_visible_mark(self):
-        return self.view.get_regions("jove_mark") != None and len(self.view.get_regions("jove_mark")) > 0
+        return self.displayed is not None and len(self.displayed[1]) > 0
 
     #
-    # Update the display to show the current mark.
+    # Returns the mark being displayed, or [] if there isn't one.
+    #
+    def get_visible(self):
+        return self.get() if self.displayed is not None else []
+
+    #
+    # Update the display to show the current mark, if it's not already showing.
     #
     def display(self):
         # display the mark's dot
         regions = self.get()
-        if regions is not None:
-            self.view.add_regions("jove_mark", regions, "mark", "dot", sublime.HIDDEN)
+        if regions is not None and self.displayed != (self.index, regions):
+            for view in self.views:
+                view.add_regions("jove_mark", regions, "mark", "dot", sublime.HIDDEN)
+            self.displayed = (self.index, regions)
 
     #
     # Get the current mark(s).
     #
     def get(self):
-        return self.view.get_regions(self.get_key(self.index))
+        if self.index not in self.used:
+            return None
+        change_count = self.view.change_count()
+        if self.current is None or self.current_change_count != change_count:
+            self.current = self.view.get_regions(self.get_key(self.index))
+            self.current_change_count = change_count
+        return self.current
 
     #
     # Set the mark to pos. If index is supplied we overwrite that mark, otherwise we push to the
@@ -53,8 +125,11 @@ class MarkRing:
             # don't set another mark in the same place
             return
         if not reuse_index:
-            self.index = (self.index + 1) % self.MARK_RING_SIZE
+            self.index = (self.index + 1) % self.size
         self.view.add_regions(self.get_key(self.index), regions, "mark", "", sublime.HIDDEN)
+        self.used.add(self.index)
+        self.current = list(regions)
+        self.current_change_count = self.view.change_count()
         self.display()
 
     #
@@ -78,8 +153,75 @@ class MarkRing:
         while True:
             self.index -= 1
             if self.index < 0:
-                self.index = self.MARK_RING_SIZE - 1
-            if self.get() or self.index == start:
+                self.index = self.size - 1
+            if self.index in self.used or self.index == start:
                 break
+        self.current = None
         self.display()
         return regions
+
+#
+# The global mark ring: (buffer_id, key) pairs, oldest first, where key names a region (in the
+# buffer's mark ring's owner view) holding the mark. A new entry is added whenever a mark is set in
+# a different buffer from the most recent entry. Entries for buffers which have been closed are
+# skipped (and dropped) when we come across them, and the oldest entries are dropped when the ring is
+# full.
+#
+global_marks = deque()
+global_mark_ring_size = None
+next_global_key = 0
+
+#
+# Called whenever a mark is set in the specified view.
+#
+def record_global_mark(view, regions):
+    global global_mark_ring_size, next_global_key
+
+    buffer_id = view.buffer_id()
+    if global_marks and global_marks[-1][0] == buffer_id:
+        return
+    ring = MarkRing.rings.get(buffer_id, None)
+    if ring is None:
+        return
+
+    if global_mark_ring_size is None:
+        from .misc import SettingsHelper
+        global_mark_ring_size = SettingsHelper().get("sbp_global_mark_ring_size", 16)
+    if global_mark_ring_size <= 0:
+        # the global mark ring is turned off
+        return
+    while len(global_marks) >= global_mark_ring_size:
+        evict_global_mark(*global_marks.popleft())
+
+    key = "jove_global_mark:" + str(next_global_key)
+    next_global_key += 1
+    ring.view.add_regions(key, regions, "mark", "", sublime.HIDDEN)
+    ring.global_keys.add(key)
+    global_marks.append((buffer_id, key))
+
+def evict_global_mark(buffer_id, key):
+    ring = MarkRing.rings.get(buffer_id, None)
+    if ring is not None:
+        ring.view.erase_regions(key)
+        ring.global_keys.discard(key)
+
+#
+# Pops the most recent global mark, and moves it to the other end of the ring so that repeated pops
+# cycle through all of them. Returns the (view, regions) to go to, preferring a view in window, or None
+# if there are no global marks.
+#
+def pop_global_mark(window):
+    while global_marks:
+        buffer_id, key = global_marks.pop()
+        ring = MarkRing.rings.get(buffer_id, None)
+        if ring is None:
+            # the buffer has been closed
+            continue
+        global_marks.appendleft((buffer_id, key))
+        view = ring.view
+        for v in ring.views:
+            if v.window() == window:
+                view = v
+                break
+        return view, ring.view.get_regions(key)
+    return None
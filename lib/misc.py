@@ -2,6 +2,7 @@ import os, re, time, traceback
 import sublime, sublime_plugin
 
 from .viewstate import *
+from .mark_ring import record_global_mark, pop_global_mark
 
 # name we use to indicate jove-related status messages
 JOVE_STATUS = "1:jove"
@@ -82,6 +83,20 @@ def get_relative_path(roots, file_name, n_components=2):
     else:
         return "<no file>"
 
+#
+# Returns the directory in which we keep data which survives restarts (other than settings), creating
+# it if necessary. The path is remembered so that we can still find it when sublime is quitting and
+# its API has shut down.
+#
+cache_dir = None
+
+def get_cache_dir():
+    global cache_dir
+    if cache_dir is None:
+        cache_dir = os.path.join(sublime.cache_path(), "sublemacspro")
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
 #
 # A settings helper class which looks at the current view's settings and uses sublime settings as a
 # default value.
@@ -234,7 +249,7 @@ class CmdUtil:
     # Returns the mark position.
     #
     def get_mark(self):
-        mark = self.view.get_regions("jove_mark")
+        mark = self.state.mark_ring.get_visible()
         if mark:
             mark = mark[0]
             return mark.a
@@ -268,7 +283,7 @@ class CmdUtil:
         cursors = list(view.sel())
         if not self.state.active_mark and self.no_empty_regions(cursors):
             return cursors
-        marks = self.view.get_regions("jove_mark")
+        marks = self.state.mark_ring.get_visible()
         if len(marks) == len(cursors):
             regions = [sublime.Region(m.a, c.b) for m, c in zip(marks, cursors)]
             for i, r in enumerate(regions[1:]):
@@ -343,6 +358,7 @@ class CmdUtil:
 
         # update the mark ring
         mark_ring.set(regions)
+        record_global_mark(view, regions)
 
         if self.state.active_mark:
             # make sure the existing selection disappears and is replaced with an empty selection or
@@ -0,0 +1,244 @@
+#####################################################
+#      Occur - list matching lines in all buffers   #
+#####################################################
+
+from concurrent.futures import ThreadPoolExecutor
+
+import sublime, sublime_plugin
+
+from .misc import *
+from .isearch import get_search_pattern
+
+# the setting which marks a view as an occur results view
+OCCUR_RESULTS = "sbp_occur_results"
+
+# number of threads scanning buffers
+OCCUR_WORKERS = 4
+
+# number of buffers whose text we capture (on the main thread) at a time, before letting sublime get
+# on with other things
+SNAPSHOT_BATCH_SIZE = 4
+
+# we report at most this many matching lines per buffer, and truncate long lines to this many characters
+MAX_LINES_PER_BUFFER = 1000
+MAX_LINE_LENGTH = 200
+
+executor = None
+
+# results view id -> Occur
+occurs = dict()
+
+def get_executor():
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=OCCUR_WORKERS)
+    return executor
+
+def occur_for(view):
+    return occurs.get(view.id(), None)
+
+#
+# Returns the (row, col, text) for each line of text that matches regex. This runs on a worker
+# thread, so it must not touch the sublime API.
+#
+def scan(text, regex):
+    result = []
+    row = 0
+    pos = 0
+    line_end = -1
+    for m in regex.finditer(text):
+        start = m.start()
+        if start <= line_end:
+            # we already have this line
+            continue
+        row += text.count("\n", pos, start)
+        pos = start
+        line_start = text.rfind("\n", 0, start) + 1
+        line_end = text.find("\n", start)
+        if line_end < 0:
+            line_end = len(text)
+        result.append((row, start - line_start, get_line_sample(text, line_start, line_end, start)))
+        if len(result) >= MAX_LINES_PER_BUFFER:
+            break
+    return result
+
+#
+# Returns the text of the line from line_start to line_end, cut down to MAX_LINE_LENGTH characters
+# around the match at start if it's too long.
+#
+def get_line_sample(text, line_start, line_end, start):
+    if line_end - line_start <= MAX_LINE_LENGTH:
+        return text[line_start:line_end]
+    begin = max(line_start, min(start - MAX_LINE_LENGTH // 4, line_end - MAX_LINE_LENGTH))
+    end = begin + MAX_LINE_LENGTH
+    return ("..." if begin > line_start else "") + text[begin:end] + ("..." if end < line_end else "")
+
+#
+# Returns the occur results view for the specified window, creating it if necessary.
+#
+def get_results_view(window):
+    for view in window.views():
+        if view.settings().get(OCCUR_RESULTS):
+            return view
+    view = window.new_file()
+    view.set_name("*Occur*")
+    view.set_scratch(True)
+    view.set_read_only(True)
+    settings = view.settings()
+    settings.set(OCCUR_RESULTS, True)
+    settings.set("line_numbers", False)
+    settings.set("word_wrap", False)
+    return view
+
+#
+# One occur search. The text of each buffer is captured on the main thread (in most recently used
+# order, a few buffers at a time so the UI keeps going) and handed to a pool of workers to scan, using the python equivalent of the i-search pattern,
+# just like i-search does for the visible region. As the results come back they're appended to the
+# results view, still in most recently used order, so the buffers you care about most show up first
+# and the UI never waits for the rest.
+#
+# Targets maps each line in the results view to the view, row and column of the match it shows, so
+# that we can jump to it.
+#
+class Occur():
+    def __init__(self, results_view, search, regex):
+        self.results_view = results_view
+        self.search = search
+        self.regex = regex
+        self.targets = dict()
+        self.n_lines = 0
+        self.futures = []
+        self.done = dict()
+        self.next_index = 0
+        self.views = []
+        self.n_matches = 0
+        self.n_buffers = 0
+        self.cancelled = False
+
+    #
+    # Start scanning the specified views.
+    #
+    def start(self, views, regex):
+        occurs[self.results_view.id()] = self
+        self.views = views
+        self.write("clear")
+        self.append("%s\"%s\" in %s\n\n" % ("Regexp occur " if self.regex else "Occur ", self.search,
+                                            pluralize("buffer", len(views))))
+        self.update_status()
+        self.submit(0, regex)
+
+    #
+    # Capture the text of the next few buffers starting with the one with the specified index, and
+    # hand them to the workers. The rest are done later.
+    #
+    def submit(self, index, regex):
+        if self.cancelled:
+            return
+        executor = get_executor()
+        end = min(index + SNAPSHOT_BATCH_SIZE, len(self.views))
+        for i in range(index, end):
+            view = self.views[i]
+            text = view.substr(sublime.Region(0, view.size())) if view.is_valid() else ""
+            future = executor.submit(scan, text, regex)
+            future.add_done_callback(self.make_callback(i))
+            self.futures.append(future)
+        if end < len(self.views):
+            sublime.set_timeout(lambda: self.submit(end, regex), 0)
+
+    #
+    # Returns the callback for when the buffer with the specified index has been scanned. That's
+    # called on the worker thread, so we pass the result on to the main thread.
+    #
+    def make_callback(self, index):
+        def callback(future):
+            sublime.set_timeout(lambda: self.on_scanned(index, future), 0)
+        return callback
+
+    def cancel(self):
+        self.cancelled = True
+        for future in self.futures:
+            future.cancel()
+
+    #
+    # Called on the main thread when a buffer has been scanned. We only show the results for a
+    # buffer once the results for all the buffers before it have been shown.
+    #
+    def on_scanned(self, index, future):
+        if self.cancelled or future.cancelled():
+            return
+        self.done[index] = future.result()
+        while self.next_index in self.done:
+            self.show(self.views[self.next_index], self.done.pop(self.next_index))
+            self.next_index += 1
+        self.update_status()
+
+    def show(self, view, lines):
+        if not lines or not view.is_valid():
+            return
+        self.n_buffers += 1
+        self.n_matches += len(lines)
+        first = self.n_lines + 1
+        text = [(view.file_name() or view.name() or "untitled") + ":\n"]
+        for i, (row, col, line) in enumerate(lines):
+            text.append("%6d: %s\n" % (row + 1, line))
+            self.targets[first + i] = (view, row, col)
+        text.append("\n")
+        self.append("".join(text))
+
+    def update_status(self):
+        if self.next_index < len(self.views):
+            msg = "Searching %d of %d buffers ..." % (self.next_index, len(self.views))
+        else:
+            msg = "%s in %s" % (pluralize("matching line", self.n_matches), pluralize("buffer", self.n_buffers))
+        set_jove_status(self.results_view, msg, self.next_index == len(self.views))
+
+    def append(self, text):
+        self.n_lines += text.count("\n")
+        self.write("append", text)
+
+    def write(self, cmd, text=None):
+        if self.results_view.is_valid():
+            self.results_view.run_command("sbp_occur_results", {"cmd": cmd, "text": text})
+
+    #
+    # Returns the view and point of the match shown on the specified row of the results view, or None.
+    #
+    def target_at(self, row):
+        target = self.targets.get(row, None)
+        if target is None or not target[0].is_valid():
+            return None
+        view, row, col = target
+        return view, view.text_point(row, col)
+
+#
+# Run an occur search for the specified string over all the open buffers (in every window), other
+# than occur results views, and show the results in window. Each buffer is searched once, no matter
+# how many views it has. Returns the results view, or None if the search string is not a valid
+# regex.
+#
+def occur(window, search, regex):
+    python_regex = get_search_pattern(search, regex).get_regex()
+    if python_regex is None:
+        return None
+
+    results_view = get_results_view(window)
+    current = occur_for(results_view)
+    if current is not None:
+        current.cancel()
+
+    views = []
+    buffer_ids = set()
+    for view in ViewState.sorted_views(None):
+        if view.buffer_id() in buffer_ids or view.settings().get(OCCUR_RESULTS):
+            continue
+        buffer_ids.add(view.buffer_id())
+        views.append(view)
+
+    Occur(results_view, search, regex).start(views, python_regex)
+    window.focus_view(results_view)
+    return results_view
+
+def on_close(view):
+    current = occurs.pop(view.id(), None)
+    if current is not None:
+        current.cancel()
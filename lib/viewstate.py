@@ -4,34 +4,72 @@ import sublime, sublime_plugin
 
 from .mark_ring import MarkRing
 
+# the touched time is written to the view's settings at most this often (in seconds) while it's in use
+TOUCH_SAVE_INTERVAL = 1.0
+
 #
 # We store state about each view. In particular, the mark ring, whether active_mark is set, a
 # boolean to manage resetting the target column, the argument count, this and previous command
 # names, and the last touched time. Only last touched time is saved when sublime exits.
 #
+# The touched time is kept in python and copied to the view's settings (which is what sublime saves)
+# only occasionally, because writing settings is slow and notifies all the settings listeners.
+#
 class ViewState():
     # per view state
     view_state_dict = dict()
 
+    # buffer_id -> list of the states for the views of that buffer
+    buffer_states = dict()
+
     # currently active view
     current = None
 
     def __init__(self, view):
         ViewState.view_state_dict[view.id()] = self
         self.view = view
+        self.buffer_id = view.buffer_id()
+        ViewState.buffer_states.setdefault(self.buffer_id, []).append(self)
         self.active_mark = False
-        self.touched = view.settings().get("touched")
+        self.touched = self.saved_touched = view.settings().get("touched")
         if self.touched is None:
             self.touch()
 
-        # a mark ring per view (should be per buffer)
-        self.mark_ring = MarkRing(view)
+        # a mark ring per buffer, shared with the other views of this buffer
+        self.mark_ring = MarkRing.for_view(view)
         self.reset()
 
+    @classmethod
+    def on_view_pre_close(cls, view):
+        state = cls.view_state_dict.get(view.id(), None)
+        if state is not None:
+            state.mark_ring.remove_view(view)
+
+    #
+    # Writes the touched time of the specified view to its settings, if it has changed.
+    #
+    @classmethod
+    def save_touched_for(cls, view):
+        state = cls.view_state_dict.get(view.id(), None)
+        if state is not None:
+            state.save_touched()
+
+    @classmethod
+    def save_all_touched(cls):
+        for state in list(cls.view_state_dict.values()):
+            state.save_touched()
+
     @classmethod
     def on_view_closed(cls, view):
-        if view.id() in cls.view_state_dict:
-            del(cls.view_state_dict[view.id()])
+        state = cls.view_state_dict.pop(view.id(), None)
+        if state is None:
+            return
+        states = cls.buffer_states.get(state.buffer_id, [])
+        states = [s for s in states if s is not state]
+        if states:
+            cls.buffer_states[state.buffer_id] = states
+        else:
+            cls.buffer_states.pop(state.buffer_id, None)
 
     #
     # Finds ot creates the state for the given view. This doesn't imply a touch().
@@ -59,12 +97,15 @@ class ViewState():
         return ViewState.current
 
     #
-    # Returns a list of views from a given window sorted by most recently accessed/touched. If group
-    # is specified, uses only views in that group.
+    # Returns a list of views from a given window (or all the windows if window is None) sorted by
+    # most recently accessed/touched. If group is specified, uses only views in that group.
     #
     @classmethod
     def sorted_views(cls, window, group=None):
-        views = window.views_in_group(group) if group is not None else window.views()
+        if window is None:
+            views = [view for window in sublime.windows() for view in window.views()]
+        else:
+            views = window.views_in_group(group) if group is not None else window.views()
         states = [cls.find_or_create(view) for view in views]
         sorted_states = sorted(states, key=lambda state: state.touched, reverse=True)
         return [state.view for state in sorted_states]
@@ -75,17 +116,22 @@ class ViewState():
     #
     @classmethod
     def most_recent_related_view(cls, view):
-        view_states = cls.view_state_dict
-        buffer_id = view.buffer_id()
         best = None
-        for view_id in view_states:
-            state = view_states[view_id]
-            if state.view.buffer_id() == buffer_id:
-                if best is None or best.touched < state.touched:
-                    best = state
+        for state in cls.buffer_states.get(view.buffer_id(), ()):
+            if best is None or best.touched < state.touched:
+                best = state
         if best is not None:
             yield best.view
 
+    #
+    # Returns True if view is the only view we know of into its buffer, e.g., when deciding whether
+    # closing it closes the buffer.
+    #
+    @classmethod
+    def is_last_view(cls, view):
+        view_id = view.id()
+        return all(state.view.id() == view_id for state in cls.buffer_states.get(view.buffer_id(), ()))
+
     #
     # Reset the state for this view.
     #
@@ -103,7 +149,13 @@ class ViewState():
     #
     def touch(self):
         self.touched = time.time()
-        self.view.settings().set("touched", self.touched)
+        if self.saved_touched is None or self.touched - self.saved_touched >= TOUCH_SAVE_INTERVAL:
+            self.save_touched()
+
+    def save_touched(self):
+        if self.touched != self.saved_touched:
+            self.view.settings().set("touched", self.touched)
+            self.saved_touched = self.touched
 
     #
     # Get the argument count and reset it for the next command (unless peek is True).
@@ -0,0 +1,150 @@
+import os, time
+
+import sublime, sublime_plugin
+
+from .misc import get_cache_dir
+from .word_index import WordIndex
+
+VOCABULARY_FILE = "vocabulary.log"
+
+# maximum number of words we remember - the least recently seen ones are dropped when compacting
+MAX_VOCABULARY_SIZE = 50000
+
+#
+# The vocabulary remembers the words from buffers that have been closed, so that they can still be
+# completed, even after a restart. Each word has its frequency (in the file it was last seen in), the
+# last file it was seen in, and when that was.
+#
+# On disk it's an append-only log with one "stamp<TAB>count<TAB>word<TAB>file" line per word. Later
+# lines for the same word replace earlier ones. When the log has grown to twice the number of words
+# it holds, or holds too many words, it's rewritten with just the most recent entry for the most
+# recently seen words.
+#
+# It is a WordIndex as far as the completion engine is concerned, with its own (never used) buffer id.
+#
+class Vocabulary(WordIndex):
+    buffer_id = -1
+
+    def __init__(self, path):
+        self.path = path
+        self.counts = dict()
+        self.files = dict()
+        self.stamps = dict()
+        self.keys = self.words = None
+        self.change_count = 0
+        self.n_records = 0
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    fields = line.rstrip("\n").split("\t", 3)
+                    if len(fields) != 4:
+                        continue
+                    stamp, count, word, file_name = fields
+                    self.set(word, int(count), file_name, float(stamp))
+                    self.n_records += 1
+        except (IOError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                print("Error loading vocabulary", e)
+
+    def set(self, word, count, file_name, stamp):
+        if word not in self.counts:
+            self.keys = self.words = None
+        self.counts[word] = count
+        self.files[word] = file_name
+        self.stamps[word] = stamp
+
+    def file_for(self, word):
+        return self.files.get(word, None)
+
+    #
+    # Add the words and counts in the specified dict, seen in file_name, and return the lines to
+    # append to the log.
+    #
+    def record(self, counts, file_name):
+        stamp = time.time()
+        lines = []
+        for word, count in counts.items():
+            self.set(word, count, file_name, stamp)
+            lines.append("%.0f\t%d\t%s\t%s\n" % (stamp, count, word, file_name))
+        self.change_count += 1
+        self.n_records += len(lines)
+        return lines
+
+    def needs_compaction(self):
+        return self.n_records > 2 * len(self.counts) or len(self.counts) > MAX_VOCABULARY_SIZE
+
+    #
+    # Returns the lines for a compacted log, dropping the least recently seen words if there are too
+    # many of them.
+    #
+    def compact(self):
+        words = sorted(self.counts, key=lambda word: self.stamps[word], reverse=True)
+        for word in words[MAX_VOCABULARY_SIZE:]:
+            del(self.counts[word])
+            del(self.files[word])
+            del(self.stamps[word])
+        self.keys = self.words = None
+        self.change_count += 1
+        words = words[:MAX_VOCABULARY_SIZE]
+        self.n_records = len(words)
+        return ["%.0f\t%d\t%s\t%s\n" % (self.stamps[word], self.counts[word], word, self.files[word])
+                for word in reversed(words)]
+
+# the vocabulary, once it's loaded
+vocabulary = None
+loading = False
+
+#
+# Returns the vocabulary if it has been loaded. The first call starts loading it in the background,
+# so it's available for the next completion.
+#
+def get_vocabulary():
+    global loading
+
+    if vocabulary is None and not loading:
+        loading = True
+        path = os.path.join(get_cache_dir(), VOCABULARY_FILE)
+
+        def install(vocab):
+            global vocabulary
+            vocabulary = vocab
+
+        def load():
+            vocab = Vocabulary(path)
+            vocab.load()
+            if vocab.needs_compaction():
+                write_lines(path, vocab.compact(), "w")
+            sublime.set_timeout(lambda: install(vocab), 0)
+        sublime.set_timeout_async(load, 0)
+    return vocabulary
+
+#
+# Remember the words in the specified index, which belongs to a buffer that's being closed. We only
+# do this once the vocabulary has been loaded, i.e., once completion has been used.
+#
+def record(index, file_name):
+    vocab = get_vocabulary()
+    if vocab is None or file_name is None or not index.counts:
+        return
+    lines = vocab.record(index.counts, file_name)
+    if vocab.needs_compaction():
+        lines = vocab.compact()
+        mode = "w"
+    else:
+        mode = "a"
+    sublime.set_timeout_async(lambda: write_lines(vocab.path, lines, mode), 0)
+
+def write_lines(path, lines, mode):
+    try:
+        if mode == "w":
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.writelines(lines)
+            os.replace(tmp, path)
+        else:
+            with open(path, "a", encoding="utf-8") as f:
+                f.writelines(lines)
+    except (IOError, OSError) as e:
+        print("Error saving vocabulary", e)
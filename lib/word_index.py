@@ -0,0 +1,484 @@
+import re, heapq, time
+from bisect import bisect_left
+from collections import OrderedDict
+
+import sublime, sublime_plugin
+
+MIN_WORD_SIZE = 3
+MAX_WORD_SIZE = 100
+
+# how long a buffer must be left alone before a stale index is rebuilt from scratch (ms)
+REBUILD_DELAY = 1000
+
+# buffers larger than this (in characters) are only ever indexed in the background
+SYNC_INDEX_LIMIT = 1000000
+
+# How many characters we can index per millisecond. This starts out as a conservative guess and is
+# then measured as we go, so that we only index a buffer while the user waits if it fits in the time
+# budget.
+index_rate = 5000.0
+
+# lines longer than this (in characters) are never diffed - editing them makes the index stale
+MAX_DIFF_LINE_SIZE = 10000
+
+# number of (buffer, prefix) match sets we remember
+MATCH_CACHE_SIZE = 512
+
+#
+# A per-buffer index of the words in a buffer, used by the all-buffers completion code. The index is
+# built once by scanning the whole buffer and is then kept up to date from on_modified events. The
+# common cases (typing within a line, splitting a line or joining two lines, with a single cursor)
+# are handled exactly by diffing the words on the affected lines before and after the change. For
+# that we keep a snapshot of the words on the cursor's line and the lines either side of it, which
+# is taken when the index is built and whenever the cursor moves to another line. Anything else
+# (multiple cursors, multi-line selections or edits, very long lines) adds the words on the current
+# line right away and marks the index as stale, so that it's rebuilt from scratch once the buffer
+# has been left alone for a moment.
+#
+# Words are kept in a dict of word -> count, plus a lazily built sorted array of the lower case
+# words so that we can find all the words starting with a given character with a binary search.
+#
+class WordIndex():
+    def __init__(self, view, extra_word_characters, separator_characters):
+        self.buffer_id = view.buffer_id()
+        self.syntax = view.settings().get("syntax")
+        self.extra = extra_word_characters
+        self.separators = separator_characters
+        self.word_re = re.compile(r'[\w' + "".join(re.escape(c) for c in extra_word_characters) + r']+')
+
+        # Separators which are also word characters in this syntax (e.g., "." and "-" in HTML). We
+        # also index the tail of a word starting at each of these, so "a.foo" can complete ".foo".
+        self.inner_separators = "".join(c for c in extra_word_characters if c in separator_characters)
+
+        self.counts = dict()
+        self.keys = self.words = None
+        self.stale = False
+        self.snapshot = None
+        self.rebuild(view)
+
+    #
+    # Scan the whole buffer and rebuild the index.
+    #
+    def rebuild(self, view):
+        # read this first, so that an edit made while we're reading the text counts as unseen
+        change_count = view.change_count()
+        start = time.time()
+        counts = dict()
+        text = view.substr(sublime.Region(0, view.size()))
+        for word in self.extract(text):
+            counts[word] = counts.get(word, 0) + 1
+        record_index_rate(len(text), time.time() - start)
+        self.counts = counts
+        self.keys = self.words = None
+        self.stale = False
+        self.change_count = change_count
+        self.snapshot = self.take_snapshot(view)
+
+    #
+    # Returns the list of indexable words in the specified text.
+    #
+    def extract(self, text):
+        result = []
+        separators = self.inner_separators
+        for word in self.word_re.findall(text):
+            if len(word) > MAX_WORD_SIZE:
+                continue
+            if len(word) >= MIN_WORD_SIZE:
+                result.append(word)
+            if separators:
+                for i in range(1, len(word) - MIN_WORD_SIZE + 1):
+                    if word[i] in separators:
+                        result.append(word[i:])
+        return result
+
+    def add(self, words):
+        counts = self.counts
+        for word in words:
+            count = counts.get(word, 0)
+            if count == 0:
+                self.keys = self.words = None
+            counts[word] = count + 1
+
+    def remove(self, words):
+        counts = self.counts
+        for word in words:
+            count = counts.get(word, 0)
+            if count <= 1:
+                if count == 1:
+                    del(counts[word])
+                    self.keys = self.words = None
+            else:
+                counts[word] = count - 1
+
+    #
+    # Returns (length, words) for the specified line, where words is None if the line is too long to
+    # diff. A line which doesn't exist is (0, []).
+    #
+    def get_line_words(self, view, row, n_lines):
+        if row < 0 or row > n_lines:
+            return 0, []
+        line = view.line(view.text_point(row, 0))
+        if line.size() > MAX_DIFF_LINE_SIZE:
+            return line.size(), None
+        return line.size(), self.extract(view.substr(line))
+
+    #
+    # Returns a snapshot of the lines around the cursor, for diffing against after the next change:
+    # (view_id, row, n_lines, size, [line above, line, line below]) where each line is (length,
+    # words) and size is the size of the buffer. Returns None if there's more than one cursor or the
+    # selection spans lines, since we cannot diff those edits.
+    #
+    def take_snapshot(self, view):
+        sel = view.sel()
+        if len(sel) != 1:
+            return None
+        region = sel[0]
+        row = view.rowcol(region.b)[0]
+        if not region.empty() and view.rowcol(region.a)[0] != row:
+            return None
+        size = view.size()
+        n_lines = view.rowcol(size)[0]
+        lines = [self.get_line_words(view, r, n_lines) for r in (row - 1, row, row + 1)]
+        return (view.id(), row, n_lines, size, lines)
+
+    #
+    # Called when the selection has changed in an unmodified buffer (or a view has been activated),
+    # so that we have the right lines to diff against when it is modified. This is cheap unless the
+    # cursor has moved to another line.
+    #
+    def check_snapshot(self, view):
+        snapshot = self.snapshot
+        if snapshot is not None and snapshot[0] == view.id():
+            sel = view.sel()
+            if len(sel) == 1 and sel[0].empty() and view.rowcol(sel[0].b)[0] == snapshot[1]:
+                return
+        self.snapshot = self.take_snapshot(view)
+
+    #
+    # Called when the buffer has been modified. See the class comment for how this works.
+    #
+    def update(self, view):
+        change_count = view.change_count()
+        if change_count == self.change_count:
+            return
+        snapshot, self.snapshot = self.snapshot, None
+        sel = view.sel()
+        if len(sel) == 1:
+            row = view.rowcol(sel[0].b)[0]
+            n_lines = view.rowcol(view.size())[0]
+            exact = (snapshot is not None and snapshot[0] == view.id() and
+                     change_count == self.change_count + 1 and self.diff_lines(view, snapshot, row, n_lines))
+            if not exact:
+                # we don't know what the edited lines used to contain
+                words = self.get_line_words(view, row, n_lines)[1]
+                if words is not None:
+                    self.add(words)
+                self.stale = True
+        else:
+            self.stale = True
+        self.change_count = change_count
+
+    #
+    # Diff the words on the lines affected by a single edit at the cursor, where the cursor is now at
+    # row and the buffer has n_lines lines. The edit either changed the snapshot's cursor line,
+    # split it in two, or joined it with the line before or after it. Returns False if it's none of
+    # those (or one of the lines is too long), in which case the index is unchanged.
+    #
+    # The cursor ending up in the right place isn't enough to go on, e.g., a plugin inserting a line at
+    # the top of the buffer looks like a line split. So the change in the size of the buffer must
+    # also be the change in the size of the lines we're diffing.
+    #
+    def diff_lines(self, view, snapshot, row, n_lines):
+        old_row, old_n_lines, old_size, old_lines = snapshot[1:]
+        delta = n_lines - old_n_lines
+        if delta == 0 and row == old_row:
+            old, new_rows = old_lines[1:2], [row]
+        elif delta == 1 and row in (old_row, old_row + 1):
+            old, new_rows = old_lines[1:2], [old_row, old_row + 1]
+        elif delta == -1 and row == old_row - 1:
+            old, new_rows = old_lines[0:2], [row]
+        elif delta == -1 and row == old_row:
+            old, new_rows = old_lines[1:3], [row]
+        else:
+            return False
+        new = [self.get_line_words(view, r, n_lines) for r in new_rows]
+        if any(line[1] is None for line in old + new):
+            return False
+        size = view.size()
+        span = lambda lines: sum(line[0] for line in lines) + len(lines) - 1
+        if size - old_size != span(new) - span(old):
+            return False
+        for length, words in old:
+            self.remove(words)
+        for length, words in new:
+            self.add(words)
+
+        if delta == 0:
+            # the lines either side are unchanged
+            self.snapshot = (view.id(), row, n_lines, size, [old_lines[0], new[0], old_lines[2]])
+        else:
+            self.snapshot = self.take_snapshot(view)
+        return True
+
+    #
+    # Returns the sorted (lower case) keys and the corresponding words, building them if necessary.
+    #
+    def get_sorted(self):
+        if self.keys is None:
+            pairs = sorted((word.lower(), word) for word in self.counts)
+            self.keys = [pair[0] for pair in pairs]
+            self.words = [pair[1] for pair in pairs]
+        return self.keys, self.words
+
+    #
+    # Returns the (word, count) pairs for all the words which start with the first character of
+    # prefix (in either case). This is the candidate set for both exact and fuzzy prefix matching.
+    #
+    def candidates(self, prefix):
+        keys, words = self.get_sorted()
+        first = prefix[0].lower()
+        start = bisect_left(keys, first)
+        end = bisect_left(keys, chr(ord(first) + 1), start)
+        counts = self.counts
+        return [(word, counts[word]) for word in words[start:end]]
+
+    #
+    # Returns the indexed word at the specified point, if any.
+    #
+    def word_at(self, view, point):
+        line = view.line(point)
+        col = point - line.a
+        for match in self.word_re.finditer(view.substr(line)):
+            if match.start() <= col <= match.end():
+                return match.group(0)
+            if match.start() > col:
+                break
+        return None
+
+#
+# Returns how well word matches prefix, or None if it doesn't match at all. Words must be longer than
+# the prefix and start with the same character. Exact prefix matches score highest (shorter words
+# first), followed by subsequence ("fuzzy") matches, which score better the fewer characters they
+# skip and the more of the prefix characters land at the start of a part of the word, as in
+# "gV" -> "getValue" or "gv" -> "get_value".
+#
+def match_score(prefix, word, ignore_case):
+    text = word.lower() if ignore_case else word
+    if len(text) <= len(prefix) or text[0] != prefix[0]:
+        return None
+    if text.startswith(prefix):
+        return 1000 - len(text)
+    score = 500 - len(text)
+    pos = 1
+    for ch in prefix[1:]:
+        found = text.find(ch, pos)
+        if found < 0:
+            return None
+        if found > pos:
+            score -= found - pos
+            prev = word[found - 1]
+            if not prev.isalnum() or (word[found].isupper() and not prev.isupper()):
+                score += 10
+        pos = found + 1
+    return score
+
+#
+# The completion engine. Queries is a list of (index, prefix, exclude, data) tuples in order of
+# preference (i.e., most recently used buffer first), where exclude is a word which should only be
+# included if it appears more than once in that index (the word being completed), and data is
+# returned to the caller with each result. Returns the best limit (word, data) pairs, best first.
+# Each word is returned once, from the query which scored it highest. The words from the
+# fallback_queries (e.g., the vocabulary of closed files) all come after the words from queries, no
+# matter how well they score.
+#
+def top_completions(queries, ignore_case, limit, fallback_queries=()):
+    best = dict()
+    all_queries = [(1, query) for query in queries] + [(0, query) for query in fallback_queries]
+    for rank, (tier, query) in enumerate(all_queries):
+        index, prefix, exclude, data = query
+        for word, count, score in get_matches(index, prefix, ignore_case):
+            if word == exclude and count <= 1:
+                continue
+            key = (tier, score, -rank, count)
+            current = best.get(word, None)
+            if current is None or current[0] < key:
+                best[word] = (key, data)
+    top = heapq.nlargest(limit, best.items(), key=lambda item: item[1][0])
+    return [(word, data) for word, (key, data) in top]
+
+#
+# Cache of the matches for a prefix in a buffer: (buffer_id, prefix, ignore_case) -> (index,
+# change_count, matches) in least recently used order. An entry is only good for the index and change
+# count it was computed from, and entries are evicted as soon as their buffer is modified.
+#
+match_cache = OrderedDict()
+match_cache_keys = dict()
+
+#
+# Returns the (word, count, score) triples for all the words in index which match prefix. When the
+# user is typing, the matches for the previous prefix are usually cached, and since anything which
+# matches "getV" also matches "get", we only need to rescore those rather than all the candidates.
+# This doesn't work the other way around for case: case sensitive matches are a subset of case
+# insensitive ones, but not vice versa.
+#
+def get_matches(index, prefix, ignore_case):
+    buffer_id = index.buffer_id
+    key = (buffer_id, prefix, ignore_case)
+    entry = match_cache.get(key, None)
+    if entry is not None and entry[0] is index and entry[1] == index.change_count:
+        match_cache.move_to_end(key)
+        return entry[2]
+
+    candidates = None
+    for n in range(len(prefix) - 1, 0, -1):
+        for cached_ignore_case in (True,) if ignore_case else (False, True):
+            entry = match_cache.get((buffer_id, prefix[:n], cached_ignore_case), None)
+            if entry is not None and entry[0] is index and entry[1] == index.change_count:
+                candidates = entry[2]
+                break
+        if candidates is not None:
+            break
+    if candidates is None:
+        candidates = index.candidates(prefix)
+
+    matches = []
+    for candidate in candidates:
+        word, count = candidate[0], candidate[1]
+        score = match_score(prefix, word, ignore_case)
+        if score is not None:
+            matches.append((word, count, score))
+
+    match_cache[key] = (index, index.change_count, matches)
+    match_cache_keys.setdefault(buffer_id, set()).add(key)
+    while len(match_cache) > MATCH_CACHE_SIZE:
+        old_key, old_entry = match_cache.popitem(last=False)
+        match_cache_keys[old_key[0]].discard(old_key)
+    return matches
+
+#
+# Evict all the cached matches for the specified buffer.
+#
+def evict_matches(buffer_id):
+    keys = match_cache_keys.pop(buffer_id, None)
+    if keys:
+        for key in keys:
+            del(match_cache[key])
+
+#
+# Update index_rate from a build of the specified number of characters which took elapsed seconds.
+# Small buffers don't tell us much.
+#
+def record_index_rate(size, elapsed):
+    global index_rate
+    if size >= 10000 and elapsed > 0:
+        index_rate = (index_rate + size / (elapsed * 1000)) / 2
+
+#
+# Returns True if a buffer of the specified size can (probably) be indexed in ms milliseconds.
+#
+def can_index_within(size, ms):
+    return size <= SYNC_INDEX_LIMIT and size <= ms * index_rate
+
+# buffer_id -> WordIndex
+indexes = dict()
+
+# buffer_ids with a pending rebuild
+pending_rebuilds = set()
+
+# buffer_ids being indexed in the background
+pending_builds = set()
+
+#
+# Returns the word index for the specified view. If build is True, the index is created (or rebuilt)
+# right now if necessary. Otherwise we return the index we have, even if it's stale, or None if
+# there isn't one yet, and leave it to build_async to bring it up to date.
+#
+def index_for(view, extra_word_characters, separator_characters, build=True):
+    index = indexes.get(view.buffer_id(), None)
+    if index is None or index.syntax != view.settings().get("syntax") or index.extra != extra_word_characters:
+        if not build:
+            return None
+        index = WordIndex(view, extra_word_characters, separator_characters)
+        indexes[index.buffer_id] = index
+    elif index.change_count != view.change_count():
+        # we missed some modifications
+        if build:
+            index.rebuild(view)
+        else:
+            build_async(view, extra_word_characters, separator_characters)
+    return index
+
+#
+# Build the index for the specified view on the async thread, and install it back on the main thread
+# when it's done. Requests are handled in the order they're made, so if the caller asks for views in
+# most recently used order, that's the order they become available for completion.
+#
+def build_async(view, extra_word_characters, separator_characters):
+    buffer_id = view.buffer_id()
+    if buffer_id in pending_builds:
+        return
+    pending_builds.add(buffer_id)
+
+    def install(index):
+        pending_builds.discard(buffer_id)
+        if index is None or not view.is_valid():
+            return
+        indexes[buffer_id] = index
+        evict_matches(buffer_id)
+        if index.change_count != view.change_count():
+            # modified while we were building it
+            index.stale = True
+            on_modified(view)
+
+    def build():
+        index = WordIndex(view, extra_word_characters, separator_characters) if view.is_valid() else None
+        sublime.set_timeout(lambda: install(index), 0)
+
+    sublime.set_timeout_async(build, 0)
+
+#
+# Called from on_modified. We do nothing for buffers that have not been indexed yet.
+#
+def on_modified(view):
+    buffer_id = view.buffer_id()
+    index = indexes.get(buffer_id, None)
+    if index is None:
+        return
+    evict_matches(buffer_id)
+    index.update(view)
+    if index.stale and buffer_id not in pending_rebuilds:
+        pending_rebuilds.add(buffer_id)
+        schedule_rebuild(view, index.change_count)
+
+#
+# Called from on_selection_modified and on_activated. We only care about indexed buffers with no
+# modifications we haven't seen yet.
+#
+def on_selection_modified(view):
+    index = indexes.get(view.buffer_id(), None)
+    if index is not None and index.change_count == view.change_count():
+        index.check_snapshot(view)
+
+#
+# Rebuild the index in the background once the buffer has not changed for REBUILD_DELAY
+# milliseconds. The stale index remains in use until the new one is ready.
+#
+def schedule_rebuild(view, change_count):
+    def doit():
+        buffer_id = view.buffer_id()
+        index = indexes.get(buffer_id, None)
+        if index is None or not index.stale or not view.is_valid():
+            pending_rebuilds.discard(buffer_id)
+        elif index.change_count != change_count:
+            # still changing - try again later
+            schedule_rebuild(view, index.change_count)
+        else:
+            pending_rebuilds.discard(buffer_id)
+            build_async(view, index.extra, index.separators)
+    sublime.set_timeout(doit, REBUILD_DELAY)
+
+def on_close(view):
+    buffer_id = view.buffer_id()
+    evict_matches(buffer_id)
+    if buffer_id in indexes:
+        del(indexes[buffer_id])